@@ -1,4 +1,49 @@
-from .rskrsk2cdf import rsk_to_cdf, write_metadata
-from .rskcdf2nc import cdf_to_nc
-from .globalatts import read_globalatts
-from .rsknc2diwasp import nc_to_diwasp
+import sys
+import importlib
+import importlib.util
+
+# submodules are only imported when first used, so the command-line
+# scripts and metadata-only work don't pay for importing everything
+_submodules = ['globalatts', 'profiling', 'waves', 'ncio', 'rskrsk2cdf', 'rskcdf2nc', 'rsknc2diwasp',
+               'rskpipeline', 'rskbatch', 'rskwatch', 'rskbench']
+
+# functions available from the top level, and the submodules they are in
+_functions = {'rsk_to_cdf': 'rskrsk2cdf',
+              'write_metadata': 'rskrsk2cdf',
+              'cdf_to_nc': 'rskcdf2nc',
+              'read_globalatts': 'globalatts',
+              'nc_to_diwasp': 'rsknc2diwasp'}
+
+
+def lazy_import(name):
+    """
+    Return module name, deferring the actual import until one of its
+    attributes is first used. For the heavy dependencies (xarray, pandas,
+    netCDF4), which take most of a second to import.
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named %s' % name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module('.' + name, __name__)
+    if name in _functions:
+        return getattr(importlib.import_module('.' + _functions[name], __name__), name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + _submodules + list(_functions))
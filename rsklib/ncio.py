@@ -0,0 +1,286 @@
+from __future__ import division, print_function
+
+import os
+import shutil
+import zipfile
+import numpy as np
+from . import lazy_import, profiling
+# xarray, pandas and netCDF4 are only imported when first used
+xr = lazy_import('xarray')
+pd = lazy_import('pandas')
+netCDF4 = lazy_import('netCDF4')
+
+# netCDF encoding profiles for rskrsk2cdf.xr_to_cdf and rskcdf2nc.write_nc:
+# the zlib compression level (0 for none), whether to shuffle bytes before
+# compressing, and the dtype in which to store the pressure variables
+ENCODINGS = {'none': {'complevel': 0, 'shuffle': False, 'pressure': 'float64'},
+             'zlib': {'complevel': 4, 'shuffle': True, 'pressure': 'float64'},
+             'float32': {'complevel': 4, 'shuffle': True, 'pressure': 'float32'},
+             'int16': {'complevel': 4, 'shuffle': True, 'pressure': 'int16'}}
+
+# variables whose dtype is set by the encoding profile
+PRESSURE_VARIABLES = ['P_1', 'P_1ac']
+
+# approximate uncompressed size (bytes) of the chunks written with a profile
+CHUNK_BYTES = 1024**2
+
+# step (dbar) of pressure packed as int16, giving a range of +/- 32.767 dbar
+# about the middle of the data so appended bursts will usually still fit
+INT16_RESOLUTION = 0.001
+
+def netcdf_encoding(ds, profile=None):
+    """
+    Return ds and the encoding to write it with the named profile in
+    ENCODINGS, or an empty encoding if profile is None
+    """
+
+    # xarray picks time units to suit the data in hand, which may be too
+    # coarse for bursts appended later, so use ms, as the RSK tstamps are
+    encoding = {}
+    for k in ds.variables:
+        if ds[k].dtype.kind == 'M' and ds[k].size and 'units' not in ds[k].encoding:
+            first = pd.Timestamp(ds[k].values.ravel()[0])
+            encoding[k] = {'units': 'milliseconds since %s' % first.strftime('%Y-%m-%d %H:%M:%S')}
+
+    if profile is None:
+        return ds, encoding
+
+    profile = ENCODINGS[profile]
+    ds = ds.copy()
+
+    for k in ds.variables:
+        var = ds[k]
+        if var.ndim == 0 or var.dtype.kind not in 'fiuM':
+            continue
+
+        # keep how times and coordinates are encoded, and the fill value
+        enc = dict(encoding.get(k, {}))
+        enc.update({e: var.encoding[e] for e in ['units', 'calendar', 'dtype', '_FillValue']
+                    if e in var.encoding})
+        if '_FillValue' in var.attrs:
+            var.attrs = dict(var.attrs)
+            enc['_FillValue'] = var.attrs.pop('_FillValue')
+
+        if profile['complevel']:
+            enc.update(zlib=True, complevel=profile['complevel'], shuffle=profile['shuffle'])
+            if 'time' in var.dims:
+                row = var.dtype.itemsize * var.size // max(var.sizes['time'], 1)
+                enc['chunksizes'] = tuple(max(CHUNK_BYTES // max(row, 1), 1) if d == 'time'
+                                          else var.sizes[d] for d in var.dims)
+        else:
+            enc['zlib'] = False
+
+        # float32 has a relative error below 6e-8 (under 0.01 mm at 100
+        # dbar); int16 steps of INT16_RESOLUTION, or of the range / 65534 if
+        # that is too coarse to cover it
+        if k in PRESSURE_VARIABLES:
+            enc['dtype'] = profile['pressure']
+            if profile['pressure'] == 'int16':
+                vmin = float(variable_stats(ds, [k])[k]['min'])
+                vmax = float(variable_stats(ds, [k])[k]['max'])
+                if np.isfinite(vmin):
+                    scale = max((vmax - vmin) / 65534, INT16_RESOLUTION)
+                    offset = np.round((vmax + vmin) / 2 / scale) * scale
+                    enc.update(scale_factor=scale, add_offset=offset,
+                               _FillValue=np.int16(-32768))
+                    print('Packing %s as int16 to within %g %s' % (k, scale / 2, var.attrs.get('units', '')))
+                else:
+                    enc['dtype'] = 'float32'
+            elif profile['pressure'] == 'float32' and '_FillValue' in enc:
+                enc['_FillValue'] = np.float32(enc['_FillValue'])
+
+        encoding[k] = enc
+
+    return ds, encoding
+
+def zarr_filename(filename, zarr):
+    """Name of the Zarr store written in place of the netCDF file filename"""
+
+    return os.path.splitext(filename)[0] + ('.zarr.zip' if zarr == 'zip' else '.zarr')
+
+def open_store(filename, zarr=None, **kwargs):
+    """
+    Open the netCDF file filename, or if zarr is 'dir' or 'zip' the Zarr
+    store written in its place, passing kwargs on to xarray
+    """
+
+    if zarr == 'zip':
+        import zarr as zarrlib
+        store = zarrlib.storage.ZipStore(zarr_filename(filename, zarr), mode='r')
+        return xr.open_zarr(store, **kwargs)
+    elif zarr:
+        return xr.open_zarr(zarr_filename(filename, zarr), **kwargs)
+    else:
+        return xr.open_dataset(filename, autoclose=True, **kwargs)
+
+def write_zarr(ds, filename, encoding=None, zarr='dir', workers=None):
+    """
+    Write ds to a Zarr store (a directory, or if zarr is 'zip' a zip file)
+    in place of the netCDF file filename, writing chunks on workers threads
+    """
+
+    store = zarr_filename(filename, zarr)
+
+    ds, encoding = netcdf_encoding(ds, encoding or 'none')
+
+    # every variable along time is chunked in the same whole bursts, so the
+    # chunks are independent and can be written concurrently; Zarr's own
+    # compressor is used rather than the profile's
+    row = max([ds[k].dtype.itemsize * ds[k].size // max(ds.sizes['time'], 1)
+               for k in ds.variables if 'time' in ds[k].dims] + [1])
+    nburst = max(CHUNK_BYTES // row, 1)
+
+    for k in encoding:
+        for e in ['zlib', 'complevel', 'shuffle', 'chunksizes']:
+            encoding[k].pop(e, None)
+        # Zarr stores are not appended to, so let xarray choose time units
+        if ds[k].dtype.kind == 'M' and 'units' not in ds[k].encoding:
+            encoding[k].pop('units', None)
+        # Zarr has no way to turn the fill value off, which netCDF's False
+        # does, so the first time (0) would read back as NaT
+        if encoding[k].get('_FillValue') is False:
+            encoding[k]['_FillValue'] = None
+        if 'time' in ds[k].dims:
+            encoding[k]['chunks'] = tuple(min(nburst, ds.sizes['time']) if d == 'time'
+                                          else ds.sizes[d] for d in ds[k].dims)
+
+    # a zip file is written from the directory once all the chunks are done
+    path = store[:-len('.zip')] + '.tmp' if zarr == 'zip' else store
+    for f in [path, store]:
+        if os.path.isdir(f):
+            shutil.rmtree(f)
+        elif os.path.exists(f):
+            os.remove(f)
+
+    with profiling.stage('write', file=store, bytes=ds.nbytes, workers=workers) as record:
+        delayed = ds.chunk({'time': nburst}).to_zarr(path, mode='w', encoding=encoding, compute=False)
+        delayed.compute(scheduler='threads', num_workers=workers)
+
+        if zarr == 'zip':
+            with zipfile.ZipFile(store, 'w', zipfile.ZIP_STORED, allowZip64=True) as z:
+                for root, dirs, files in os.walk(path):
+                    for f in files:
+                        z.write(os.path.join(root, f), os.path.relpath(os.path.join(root, f), path))
+            shutil.rmtree(path)
+
+        record['file_bytes'] = file_size(store)
+
+def file_size(filename):
+    """Size in bytes of a file, or of all the files in a directory such as a Zarr store"""
+
+    if os.path.isdir(filename):
+        return sum(os.path.getsize(os.path.join(root, f))
+                   for root, dirs, files in os.walk(filename) for f in files)
+    else:
+        return os.path.getsize(filename)
+
+def encode_values(var, data):
+    """Encode data as they would be stored in the netCDF variable var"""
+
+    if np.issubdtype(data.dtype, np.datetime64):
+        dates = pd.to_datetime(data.ravel()).to_pydatetime()
+        return np.asarray(netCDF4.date2num(dates, var.units, getattr(var, 'calendar', 'standard'))
+                          ).reshape(data.shape)
+    elif np.issubdtype(data.dtype, np.floating):
+        # masked values are written as the _FillValue
+        return np.ma.masked_invalid(data)
+
+    return data
+
+def same_value(var, index, value):
+    """Whether row index of the netCDF variable var holds value, times to the ms"""
+
+    stored = var[index]
+    if np.ma.is_masked(stored):
+        return False
+    if np.issubdtype(np.asarray(value).dtype, np.datetime64):
+        stored = netCDF4.num2date(stored, var.units, getattr(var, 'calendar', 'standard'),
+                                  only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+        return pd.Timestamp(stored).round('ms') == pd.Timestamp(value).round('ms')
+
+    return np.array_equal(stored, value)
+
+def append_netcdf(filename, ds, dim='time', key=None):
+    """
+    Append ds along the unlimited dimension dim of an existing netCDF file,
+    overwriting the last row if it has the same key (by default dim) value
+    """
+
+    if key is None:
+        key = dim
+
+    with netCDF4.Dataset(filename, 'a') as nc:
+        if not nc.dimensions[dim].isunlimited():
+            raise ValueError('cannot append to %s: %s is not an unlimited dimension' % (filename, dim))
+        n = len(nc.dimensions[dim])
+
+        if n and len(ds[dim]) and key in nc.variables and key in ds.variables:
+            if same_value(nc.variables[key], n - 1, ds[key].values[0]):
+                n -= 1
+
+        # check new data fit in variables packed by netcdf_encoding before
+        # writing anything
+        for k in ds.variables:
+            if k in nc.variables and 'scale_factor' in nc.variables[k].ncattrs():
+                var = nc.variables[k]
+                lo = var.add_offset - 32767 * var.scale_factor
+                hi = var.add_offset + 32767 * var.scale_factor
+                if float(ds[k].min()) < lo or float(ds[k].max()) > hi:
+                    raise ValueError('cannot append to %s: %s is outside the range %g to %g '
+                                     'it was packed for' % (filename, k, lo, hi))
+
+        for k in ds.variables:
+            if dim not in ds[k].dims or k not in nc.variables:
+                continue
+            var = nc.variables[k]
+            data = encode_values(var, ds[k].transpose(dim, *[d for d in ds[k].dims if d != dim]).values)
+
+            var[n:n + len(data)] = data
+
+            if 'minimum' in var.ncattrs() and np.ma.count(data):
+                var.minimum = min(var.minimum, data.min())
+                var.maximum = max(var.maximum, data.max())
+
+        for k in ['stop_time', 'rsk_last_tstamp', 'rsk_last_burst']:
+            if k in ds.attrs:
+                nc.setncattr(k, ds.attrs[k])
+
+def variable_stats(ds, names):
+    """
+    Return a dict of the min, max, mean, count (of valid values) and
+    nancount of each variable in names that is in ds. Statistics not already
+    cached are computed for all the variables together, so lazy data are
+    only read once, and cached in each variable's encoding. xarray drops the
+    encoding of a variable computed from another (e.g. with .where), and the
+    cache is ignored if the variable's shape or dask graph has changed.
+    """
+
+    stats = {}
+    keys = {}
+    reductions = {}
+    for k in names:
+        if k not in ds:
+            continue
+        var = ds[k]
+        keys[k] = (var.shape, var.data.name if var.chunks else None)
+        cached = var.encoding.get('stats')
+        if cached is not None and cached[0] == keys[k]:
+            stats[k] = cached[1]
+            continue
+        reductions.update({k + '_min': var.min(), k + '_max': var.max(),
+                           k + '_sum': var.sum(), k + '_count': var.count()})
+
+    reductions = xr.Dataset(reductions).compute()
+
+    for k in keys:
+        if k in stats:
+            continue
+        count = int(reductions[k + '_count'])
+        stats[k] = {'min': reductions[k + '_min'].values,
+                    'max': reductions[k + '_max'].values,
+                    'mean': reductions[k + '_sum'].values / count if count else np.nan,
+                    'count': count,
+                    'nancount': ds[k].size - count}
+        ds[k].encoding['stats'] = (keys[k], stats[k])
+
+    return stats
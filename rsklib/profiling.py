@@ -0,0 +1,195 @@
+from __future__ import division, print_function
+
+import os
+import sys
+import json
+import time
+import platform
+import cProfile
+import contextlib
+
+# functions called as hook(event, record) when each stage starts and ends
+_hooks = []
+
+# library versions for the history attribute, found once per run
+_versions = None
+
+
+def peak_memory():
+    """Return peak resident memory of this process in MB, or None if unknown"""
+
+    try:
+        import resource
+    except ImportError: # not available on Windows
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    if sys.platform == 'darwin':
+        return maxrss / 1024**2
+    else:
+        return maxrss / 1024
+
+
+def current_memory():
+    """Return the resident memory of this process now in MB, or None if unknown"""
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (IOError, OSError, ValueError): # no /proc, as on macOS and Windows
+        pass
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+
+    return psutil.Process().memory_info().rss / 1024**2
+
+
+def add_hook(hook):
+    """Call hook(event, record) at the start and end of every stage"""
+
+    if hook not in _hooks:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Stop calling hook"""
+
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+@contextlib.contextmanager
+def stage(name, **info):
+    """
+    Instrument a processing stage, as in
+
+        with profiling.stage('fetch', file=rskfile) as record:
+            a = read_burstdata(...)
+            record['rows'] = len(a['unixtime'])
+
+    The record starts as info plus the stage name. Each hook is called with
+    'start' and the record, and when the stage ends with 'end' and the
+    record, to which the wall time (seconds), the change in resident memory
+    over the stage (rss_change_mb), the peak resident memory of the process
+    so far (max_rss_mb) and, if the stage raised, the error have been added.
+    """
+
+    record = dict(info, stage=name)
+    for hook in list(_hooks):
+        hook('start', record)
+
+    rss = current_memory()
+    t0 = time.time()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        record['seconds'] = time.time() - t0
+        now = current_memory()
+        record['rss_change_mb'] = now - rss if rss is not None and now is not None else None
+        record['max_rss_mb'] = peak_memory()
+        for hook in list(_hooks):
+            hook('end', record)
+
+
+def print_hook(event, record):
+    """Print the start and end of each stage, along with the other progress messages"""
+
+    info = ', '.join('%s %s' % (k, record[k]) for k in record
+                     if k not in ['stage', 'seconds', 'rss_change_mb', 'max_rss_mb', 'error'])
+
+    if event == 'start':
+        print('Starting %s%s' % (record['stage'], ' (%s)' % info if info else ''))
+        return
+
+    msg = '%s done in %.2f s' % (record['stage'], record['seconds'])
+    if record.get('bytes') and record['seconds'] > 0:
+        msg += ', %.1f MB/s' % (record['bytes'] / 1024**2 / record['seconds'])
+    if record['rss_change_mb'] is not None:
+        msg += '; memory %+.1f MB' % record['rss_change_mb']
+    if record['max_rss_mb'] is not None:
+        msg += ' (process peak %.1f MB)' % record['max_rss_mb']
+    if info:
+        msg += ' (%s)' % info
+
+    if 'error' in record:
+        print('%s failed after %.2f s: %s' % (record['stage'], record['seconds'], record['error']))
+    else:
+        print(msg)
+
+
+def json_hook(filename):
+    """Return a hook that appends the record of each stage to filename as a line of JSON"""
+
+    def hook(event, record):
+        if event == 'end':
+            with open(filename, 'a') as f:
+                # numpy scalars are written as numbers
+                f.write(json.dumps(record, default=lambda x: x.item() if hasattr(x, 'item') else str(x)) + '\n')
+
+    return hook
+
+
+def profile_hook(directory):
+    """
+    Return a hook that runs each stage under cProfile and writes the stats
+    to <stage>-<n>.prof in directory, for use with pstats or snakeviz. A
+    stage starting while another is profiled is included in the outer one.
+    """
+
+    profiles = []
+    counts = {}
+
+    def hook(event, record):
+        if event == 'start':
+            if not profiles:
+                profiles.append((record, cProfile.Profile()))
+                profiles[0][1].enable()
+        elif profiles and profiles[0][0] is record:
+            r, profile = profiles.pop()
+            profile.disable()
+            counts[r['stage']] = counts.get(r['stage'], 0) + 1
+            profile.dump_stats(os.path.join(directory, '%s-%d.prof' % (r['stage'], counts[r['stage']])))
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    return hook
+
+
+def configure(timings=True, metrics=None, profile=None):
+    """
+    Set up the usual hooks for the command-line scripts: print_hook if
+    timings is True, json_hook writing to the file metrics and profile_hook
+    writing to the directory profile
+    """
+
+    if timings:
+        add_hook(print_hook)
+    if metrics is not None:
+        add_hook(json_hook(metrics))
+    if profile is not None:
+        add_hook(profile_hook(profile))
+
+
+def history(filename):
+    """
+    The history attribute for a Dataset processed by the script filename.
+    The library versions are only looked up the first time.
+    """
+
+    global _versions
+    if _versions is None:
+        import numpy as np
+        import xarray as xr
+        import netCDF4
+        _versions = ('Python ' + platform.python_version() + ', xarray ' + xr.__version__ +
+                     ', NumPy ' + np.__version__ + ', netCDF4 ' + netCDF4.__version__)
+
+    return 'Processed using ' + os.path.basename(filename) + ' with ' + _versions
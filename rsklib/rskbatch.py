@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+from __future__ import division, print_function
+
+import os
+import time
+import traceback
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from . import globalatts, profiling, ncio, rskrsk2cdf, rskcdf2nc, rsknc2diwasp
+
+# processing stages in the order they run
+STAGES = ['rsk', 'cdf', 'waves']
+
+
+def read_manifest(fname):
+    """
+    Read a YAML manifest listing the deployments to process. Each entry has
+    'gatts' and 'config' paths and optionally 'atmpres', 'directory' (where
+    the data files are; defaults to the manifest directory), 'native',
+    'encoding' and 'zarr'.
+    Relative paths are taken relative to the manifest.
+    """
+    import yaml
+
+    with open(fname) as f:
+        jobs = yaml.safe_load(f)
+
+    root = os.path.dirname(os.path.abspath(fname))
+
+    for job in jobs:
+        for k in ['gatts', 'config', 'atmpres', 'directory']:
+            if job.get(k) is not None:
+                job[k] = os.path.join(root, job[k])
+        job.setdefault('directory', root)
+        job.setdefault('atmpres', None)
+
+    return jobs
+
+
+def load_metadata(gatts, config):
+    """Load metadata from the globalatts file and the YAML config"""
+    import yaml
+
+    metadata = globalatts.read_globalatts(gatts)
+
+    with open(config) as f:
+        config = yaml.safe_load(f)
+
+    for k in config:
+        metadata[k] = config[k]
+
+    return metadata
+
+
+def stage_files(stage, metadata, job):
+    """Return the input and output files of a stage"""
+
+    inputs = [job['gatts'], job['config']]
+
+    if stage == 'rsk':
+        inputs.append(metadata['basefile'] + '.rsk')
+        output = metadata['filename'] + '-raw.cdf'
+    elif stage == 'cdf':
+        inputs.append(metadata['filename'] + '-raw.cdf')
+        if job['atmpres'] is not None:
+            inputs.append(job['atmpres'])
+        output = metadata['filename'] + 'b-cal.nc'
+    elif stage == 'waves':
+        inputs.append(metadata['filename'] + 'b-cal.nc')
+        if not job.get('native'):
+            inputs.append(metadata['filename'][:-2] + 'diwasp.nc')
+        output = metadata['filename'] + 's-a.nc'
+
+    # the netCDF files are replaced by Zarr stores, except diwasp.nc
+    if job.get('zarr'):
+        inputs = [ncio.zarr_filename(f, job['zarr']) if f.endswith(('-raw.cdf', 'b-cal.nc'))
+                  else f for f in inputs]
+        output = ncio.zarr_filename(output, job['zarr'])
+
+    return inputs, output
+
+
+def is_current(inputs, output):
+    """Check whether output exists and is newer than all of its inputs"""
+
+    if not os.path.exists(output):
+        return False
+
+    mtime = os.path.getmtime(output)
+
+    return all(os.path.exists(f) and os.path.getmtime(f) <= mtime for f in inputs)
+
+
+def run_stage(stage, metadata, job):
+    """Run one processing stage for a job"""
+
+    if stage == 'rsk':
+        rskrsk2cdf.rsk_to_cdf(metadata, encoding=job.get('encoding'), zarr=job.get('zarr'))
+    elif stage == 'cdf':
+        rskcdf2nc.cdf_to_nc(metadata, atmpres=job['atmpres'], encoding=job.get('encoding'),
+                            zarr=job.get('zarr'))
+    elif stage == 'waves':
+        rsknc2diwasp.nc_to_diwasp(metadata, native=job.get('native', False), encoding=job.get('encoding'),
+                                  zarr=job.get('zarr'))
+
+
+def run_job(job, force=False):
+    """
+    Run the rsk -> cdf -> nc -> waves chain for one deployment, skipping
+    stages whose output is newer than their inputs. Returns a list of
+    (stage, status, seconds) tuples.
+    """
+
+    cwd = os.getcwd()
+    try:
+        os.chdir(job['directory'])
+    except Exception as e:
+        traceback.print_exc()
+        return [('setup', 'failed: %s' % e, 0.)]
+
+    results = []
+    try:
+        for stage in STAGES:
+            t0 = time.time()
+            try:
+                # each stage gets fresh metadata, as when run from the command line
+                metadata = load_metadata(job['gatts'], job['config'])
+                inputs, output = stage_files(stage, metadata, job)
+                if not force and is_current(inputs, output):
+                    results.append((stage, 'skipped', 0.))
+                    continue
+
+                run_stage(stage, metadata, job)
+            except Exception as e:
+                traceback.print_exc()
+                results.append((stage, 'failed: %s' % e, time.time() - t0))
+                break
+            results.append((stage, 'done', time.time() - t0))
+    finally:
+        os.chdir(cwd)
+
+    return results
+
+
+def run_batch(jobs, workers=None, force=False):
+    """
+    Run all jobs on a pool of worker processes and print a summary of the
+    status and timing of each stage. Returns the results of each job.
+    """
+
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_job, job, force) for job in jobs]
+        results = []
+        for f in futures:
+            # a worker that dies, or a job that can't be sent to one, only
+            # fails that job
+            try:
+                results.append(f.result())
+            except Exception as e:
+                results.append([('setup', 'failed: %s' % e, 0.)])
+
+    print_summary(jobs, results, time.time() - t0)
+
+    return results
+
+
+def print_summary(jobs, results, elapsed):
+    """Print the status and timing of each stage of each job"""
+
+    print('')
+    print('%-40s %-6s %-30s %8s' % ('job', 'stage', 'status', 'seconds'))
+    for job, result in zip(jobs, results):
+        name = os.path.basename(job['gatts'])
+        for stage, status, seconds in result:
+            print('%-40s %-6s %-30s %8.1f' % (name, stage, status[:30], seconds))
+
+    nfailed = sum(any(r[1].startswith('failed') for r in result) for result in results)
+    print('%d jobs, %d failed, %.1f s total' % (len(jobs), nfailed, elapsed))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Process many RBR d|wave deployments listed in a YAML manifest')
+    parser.add_argument('manifest', help='path to manifest listing gatts, config and optional atmpres files for each deployment (YAML formatted)')
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true', help='rerun stages even if their outputs are up to date')
+    parser.add_argument('--native', action='store_true',
+                        help='compute waves from the pressure data instead of reading diwasp.nc, unless the manifest says otherwise')
+    parser.add_argument('--encoding', choices=sorted(ncio.ENCODINGS),
+                        help='compression and pressure dtype profile for the output files, unless the manifest says otherwise')
+    parser.add_argument('--zarr', choices=['dir', 'zip'],
+                        help='write Zarr stores (directories or zip files) instead of netCDF files, unless the manifest says otherwise')
+
+    args = parser.parse_args()
+
+    profiling.configure()
+
+    jobs = read_manifest(args.manifest)
+    for job in jobs:
+        job.setdefault('native', args.native)
+        job.setdefault('encoding', args.encoding)
+        job.setdefault('zarr', args.zarr)
+
+    results = run_batch(jobs, workers=args.workers, force=args.force)
+
+    return results
+
+if __name__ == '__main__':
+    main()
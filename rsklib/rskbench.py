@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+
+from __future__ import division, print_function
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import argparse
+import numpy as np
+from . import lazy_import, profiling, waves, rskrsk2cdf, rskcdf2nc, rsknc2diwasp
+# pandas, xarray and netCDF4 are only imported when first used
+pd = lazy_import('pandas')
+xr = lazy_import('xarray')
+netCDF4 = lazy_import('netCDF4')
+
+# stages in the order they run
+STAGES = ['fetch', 'sort', 'reshape', 'diagnostics', 'rsk_to_xr', 'raw_write', 'raw_read',
+          'trim_correct', 'epic_time', 'wave_merge', 'waves', 'qc']
+
+# QA/QC settings used by the qc stage
+QC = {'maximum_wp': 20, 'minimum_wh': 0.05, 'wp_ratio': 4}
+
+# modules with command-line entry points, which should import quickly
+ENTRY_POINTS = ['rskrsk2cdf', 'rskcdf2nc', 'rsknc2diwasp', 'rskpipeline', 'rskbatch', 'rskwatch']
+
+# dependencies that importing rsklib or an entry point must not load, and
+# the most time (s) the import may take beyond starting Python
+HEAVY_MODULES = ['xarray', 'pandas', 'netCDF4', 'aqdlib']
+IMPORT_BUDGET = 0.3
+
+# run in a fresh interpreter to time an import and see what it loaded
+IMPORT_SCRIPT = """
+import sys, time, json
+t = time.time()
+import %s
+t = time.time() - t
+heavy = [m for m in %r if m in sys.modules and type(sys.modules[m]).__name__ != '_LazyModule']
+print(json.dumps({'seconds': t, 'heavy': heavy}))
+"""
+
+
+def make_rsk(filename, nbursts, samples, samplingperiod=250, repetitionperiod=3600000,
+             shuffle=False, drop=0, index=False, start='2018-01-01', seed=0):
+    """
+    Write a synthetic d|wave .rsk file with burstdata, schedules,
+    instruments and channels tables. Pressure is 10 dbar of atmosphere plus
+    10 m of water with a semidiurnal tide, 1 m 8 s waves and noise.
+    samplingperiod and repetitionperiod are in ms. If shuffle is True blocks
+    of bursts are stored out of time order, as the logger sometimes does; a
+    fraction drop of the samples is left out at random; and if index is
+    True tstamp is the primary key. Returns the tstamp of the first sample.
+    """
+
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    rng = np.random.RandomState(seed)
+    t0 = pd.Timestamp(start).value // 10**6
+
+    conn = sqlite3.connect(filename)
+    conn.execute('CREATE TABLE burstdata (tstamp BIGINT%s, channel01 DOUBLE)'
+                 % (' PRIMARY KEY ASC' if index else ''))
+    conn.execute('CREATE TABLE schedules (samplingcount INTEGER, samplingperiod INTEGER, '
+                 'repetitionperiod INTEGER)')
+    conn.execute('CREATE TABLE instruments (serialID INTEGER, model TEXT)')
+    conn.execute('CREATE TABLE channels (channelID INTEGER PRIMARY KEY, shortName TEXT, '
+                 'longName TEXT, units TEXT)')
+    conn.execute('INSERT INTO schedules VALUES (?, ?, ?)', (samples, samplingperiod, repetitionperiod))
+    conn.execute("INSERT INTO instruments VALUES (?, 'RBRvirtuoso')", (99999,))
+    conn.execute("INSERT INTO channels VALUES (1, 'pres08', 'Pressure', 'dbar')")
+
+    blocks = np.array_split(np.arange(nbursts), max(min(nbursts, 20), 1))
+    if shuffle:
+        rng.shuffle(blocks)
+
+    for bursts in blocks:
+        t = (t0 + bursts[:, None] * repetitionperiod + np.arange(samples)[None, :] * samplingperiod).ravel()
+        seconds = (t - t0) / 1000
+        p = (20 + 0.5 * np.sin(2 * np.pi * seconds / 44712) + 0.5 * np.sin(2 * np.pi * seconds / 8)
+             + 0.01 * rng.randn(len(t)))
+        keep = rng.rand(len(t)) >= drop
+        conn.executemany('INSERT INTO burstdata VALUES (?, ?)',
+                         zip(t[keep].tolist(), p[keep].tolist()))
+
+    conn.commit()
+    conn.close()
+
+    return t0
+
+
+def make_met(filename, start, stop, interval=3600, seed=0):
+    """
+    Write a synthetic atmospheric pressure record (dbar) every interval
+    seconds from start to stop, in the form atmospheric_correction reads
+    """
+
+    rng = np.random.RandomState(seed)
+    times = pd.date_range(start, stop, freq='%ds' % interval)
+    atmpres = 10.13 + 0.05 * np.sin(2 * np.pi * np.arange(len(times)) / 120) + 0.002 * rng.randn(len(times))
+
+    met = xr.Dataset({'atmpres': xr.DataArray(atmpres, dims='time',
+                                              attrs={'units': 'dbar', 'offset': 0.})},
+                     coords={'time': times})
+    met.to_netcdf(filename)
+
+
+def make_diwasp(filename, nbursts, nfreq=128, seed=0):
+    """
+    Write synthetic DIWASP wave statistics and spectra for nbursts bursts
+    to filename, in the form rsknc2diwasp.xr_to_diwasp reads
+    """
+
+    rng = np.random.RandomState(seed)
+    frequency = np.linspace(0, 0.5, nfreq)
+    pspec = rng.gamma(2, size=(nbursts, nfreq)) * np.exp(-((frequency - 0.1) / 0.05)**2)
+
+    mat = xr.Dataset({'wh_4061': xr.DataArray(0.5 + 0.1 * rng.rand(nbursts), dims='time'),
+                      'wp_peak': xr.DataArray(8 + rng.rand(nbursts), dims='time'),
+                      'wp_4060': xr.DataArray(6 + rng.rand(nbursts), dims='time'),
+                      'pspec': xr.DataArray(pspec, dims=('time', 'frequency'))},
+                     coords={'frequency': frequency})
+    mat.to_netcdf(filename)
+
+
+def timed(stage, results, trace, func, *args, **kwargs):
+    """
+    Run func, recording under stage in results its wall time, or if trace
+    is True its peak memory as seen by tracemalloc and the peak resident
+    memory of the process. Returns what func returns.
+    """
+
+    if trace:
+        tracemalloc.start()
+
+    t0 = time.time()
+    out = func(*args, **kwargs)
+    elapsed = time.time() - t0
+
+    r = results.setdefault(stage, {})
+    if trace:
+        r['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+        r['rss_mb'] = profiling.peak_memory()
+    else:
+        r['seconds'] = min(r.get('seconds', np.inf), elapsed)
+
+    return out
+
+
+def run_stages(metadata, metfile, results, trace=False, workers=None, processes=False):
+    """
+    Run every stage once on the files named in metadata, fetching with
+    read_burstdata_parallel if workers is given
+    """
+
+    # start each run with no wavenumbers cached, as a new process would
+    waves._wavenumber_cache.clear()
+
+    conn = rskrsk2cdf.init_connection(metadata['basefile'] + '.rsk')
+    samplingcount, samplingperiod, repetitionperiod = conn.execute(
+        "select samplingcount, samplingperiod, repetitionperiod from schedules").fetchall()[0]
+    columns = [c[0] for c in rskrsk2cdf.read_channels(conn, {})]
+
+    if workers is not None:
+        a = timed('fetch', results, trace, rskrsk2cdf.read_burstdata_parallel, metadata['basefile'] + '.rsk',
+                  columns, workers, processes=processes, immutable=True)
+    else:
+        a = timed('fetch', results, trace, rskrsk2cdf.read_burstdata, conn, columns, rskrsk2cdf.CHUNKSIZE)
+    conn.connection.close()
+    timed('sort', results, trace, rskrsk2cdf.sort_burstdata, a)
+    a = timed('reshape', results, trace, rskrsk2cdf.segment_bursts, a,
+              samplingcount, samplingperiod, repetitionperiod)
+    timed('diagnostics', results, trace, rskrsk2cdf.burst_diagnostics, a[columns[0]])
+    del a
+
+    # clip to the deployment as the RSK file is read, so trim_correct does
+    # not need aqdlib
+    RAW, metadata = timed('rsk_to_xr', results, trace, rskrsk2cdf.rsk_to_xr, dict(metadata))
+    timed('raw_write', results, trace, rskrsk2cdf.xr_to_cdf, RAW, metadata)
+    del RAW
+
+    ds = timed('raw_read', results, trace,
+               lambda: xr.open_dataset(metadata['filename'] + '-raw.cdf', autoclose=True).load())
+    ds = timed('trim_correct', results, trace, rskcdf2nc.xr_to_nc, ds, dict(metadata), atmpres=metfile)
+    timed('epic_time', results, trace, rskcdf2nc.create_epic_time, ds.copy())
+    make_diwasp(metadata['filename'][:-2] + 'diwasp.nc', len(ds['time']))
+    timed('wave_merge', results, trace, rsknc2diwasp.xr_to_diwasp, ds.copy(), dict(metadata))
+    ds = timed('waves', results, trace, rsknc2diwasp.make_waves, ds, metadata)
+    timed('qc', results, trace, rsknc2diwasp.apply_qc, ds, QC)
+
+
+def time_import(module, repeat=3):
+    """
+    Time importing module in a fresh Python, keeping the best of repeat
+    runs, and find which of HEAVY_MODULES it loaded. Returns a dict.
+    """
+
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([root] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    best = None
+    for n in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT % (module, HEAVY_MODULES)],
+                                      env=env)
+        r = json.loads(out.decode().strip().splitlines()[-1])
+        if best is None or r['seconds'] < best['seconds']:
+            best = r
+
+    return best
+
+
+def measure_imports(repeat=3):
+    """
+    Time importing rsklib and each module in ENTRY_POINTS. Returns a dict
+    of the results from time_import, and a list of problems: imports that
+    load one of HEAVY_MODULES or take longer than IMPORT_BUDGET.
+    """
+
+    results = {}
+    problems = []
+    for module in ['rsklib'] + ['rsklib.' + m for m in ENTRY_POINTS]:
+        r = results[module] = time_import(module, repeat)
+        if r['heavy']:
+            problems.append('importing %s loads %s' % (module, ', '.join(r['heavy'])))
+        if r['seconds'] > IMPORT_BUDGET:
+            problems.append('importing %s takes %.3f s, more than %.3f s'
+                            % (module, r['seconds'], IMPORT_BUDGET))
+
+    return results, problems
+
+
+def print_imports(imports, problems):
+    """Print the results of measure_imports as a table"""
+
+    print('')
+    print('%-22s %10s  %s' % ('import', 'seconds', 'heavy modules loaded'))
+    for module in imports:
+        print('%-22s %10.3f  %s' % (module, imports[module]['seconds'],
+                                    ', '.join(imports[module]['heavy']) or '-'))
+    for p in problems:
+        print('Import time regression: %s' % p)
+
+
+def versions():
+    """Versions of Python, the libraries timed and the rsklib commit"""
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'rsklib': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'xarray': xr.__version__,
+            'netCDF4': netCDF4.__version__,
+            'sqlite': sqlite3.sqlite_version}
+
+
+def run_benchmark(nbursts=100, samples=2048, samplingperiod=250, repetitionperiod=3600000,
+                  shuffle=False, drop=0, index=False, repeat=3, memory=True, directory=None,
+                  workers=None, processes=False):
+    """
+    Generate a synthetic RSK file and met record in directory (by default a
+    temporary directory) and time each stage in STAGES, keeping the best of
+    repeat runs. If memory is True, one more run measures the peak memory
+    of each stage with tracemalloc; it is not timed, since tracing slows
+    Python code down. workers and processes are passed to run_stages.
+    Returns a dict of the parameters, versions and the results for each
+    stage.
+    """
+
+    params = {'nbursts': nbursts, 'samples': samples, 'samplingperiod': samplingperiod,
+              'repetitionperiod': repetitionperiod, 'shuffle': shuffle, 'drop': drop,
+              'index': index, 'repeat': repeat, 'workers': workers, 'processes': processes}
+
+    cwd = os.getcwd()
+    tmp = None
+    if directory is None:
+        tmp = tempfile.mkdtemp(prefix='rskbench')
+        directory = tmp
+    os.chdir(directory)
+
+    results = {}
+    try:
+        print('Generating %d bursts of %d samples' % (nbursts, samples))
+        t0 = make_rsk('bench.rsk', nbursts, samples, samplingperiod, repetitionperiod,
+                      shuffle=shuffle, drop=drop, index=index)
+        start = pd.to_datetime(t0, unit='ms')
+        stop = start + pd.Timedelta(milliseconds=nbursts * repetitionperiod)
+        make_met('bench-met.nc', start - pd.Timedelta(hours=1), stop + pd.Timedelta(hours=1))
+
+        # trim off the first and last bursts
+        metadata = {'basefile': 'bench',
+                    'filename': 'bench',
+                    'initial_instrument_height': 0.5,
+                    'latitude': 40.,
+                    'longitude': -70.,
+                    'WATER_DEPTH': 10.,
+                    'Deployment_date': str(start + pd.Timedelta(milliseconds=repetitionperiod / 2)),
+                    'Recovery_date': str(stop - pd.Timedelta(milliseconds=repetitionperiod * 3 / 2))}
+
+        for n in range(repeat):
+            print('Timing run %d of %d' % (n + 1, repeat))
+            run_stages(metadata, 'bench-met.nc', results, workers=workers, processes=processes)
+        if memory:
+            print('Measuring memory')
+            run_stages(metadata, 'bench-met.nc', results, trace=True, workers=workers,
+                       processes=processes)
+    finally:
+        os.chdir(cwd)
+        if tmp is not None:
+            for f in os.listdir(tmp):
+                os.remove(os.path.join(tmp, f))
+            os.rmdir(tmp)
+
+    nsamples = nbursts * samples
+    for stage in results:
+        if 'seconds' in results[stage]:
+            results[stage]['samples_per_second'] = nsamples / max(results[stage]['seconds'], 1e-9)
+
+    imports, problems = measure_imports()
+
+    return {'date': pd.Timestamp.now(tz='UTC').isoformat(),
+            'params': params,
+            'versions': versions(),
+            'stages': results,
+            'imports': imports,
+            'import_problems': problems}
+
+
+def print_results(bench):
+    """Print the results of run_benchmark as a table"""
+
+    print('')
+    print('%-14s %10s %14s %10s %10s' % ('stage', 'seconds', 'samples/s', 'peak MB', 'RSS MB'))
+    for stage in STAGES:
+        r = bench['stages'].get(stage, {})
+        print('%-14s %10.3f %14.0f %10.1f %10.1f'
+              % (stage, r.get('seconds', np.nan), r.get('samples_per_second', np.nan),
+                 r.get('peak_mb', np.nan), r.get('rss_mb') or np.nan))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Time and measure the memory use of each processing stage on synthetic d|wave data')
+    parser.add_argument('--bursts', type=int, default=100, help='number of bursts (default 100)')
+    parser.add_argument('--samples', type=int, default=2048, help='samples per burst (default 2048)')
+    parser.add_argument('--samplingperiod', type=int, default=250, help='ms between samples (default 250)')
+    parser.add_argument('--repetitionperiod', type=int, default=3600000, help='ms between bursts (default 3600000)')
+    parser.add_argument('--shuffle', action='store_true', help='store blocks of bursts out of time order')
+    parser.add_argument('--drop', type=float, default=0, help='fraction of samples to leave out (default 0)')
+    parser.add_argument('--index', action='store_true', help='make tstamp the primary key of burstdata')
+    parser.add_argument('--workers', type=int, help='fetch with this many concurrent connections')
+    parser.add_argument('--processes', action='store_true', help='use worker processes rather than threads for --workers')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs; the best is kept (default 3)')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip the memory measurement run')
+    parser.add_argument('--directory', help='directory in which to write the test files (default: a temporary directory)')
+    parser.add_argument('--output', default='rskbench.json', help='JSON file to write the results to (default rskbench.json)')
+
+    args = parser.parse_args()
+
+    bench = run_benchmark(args.bursts, args.samples, args.samplingperiod, args.repetitionperiod,
+                          shuffle=args.shuffle, drop=args.drop, index=args.index, repeat=args.repeat,
+                          memory=args.memory, directory=args.directory, workers=args.workers,
+                          processes=args.processes)
+
+    print_results(bench)
+    print_imports(bench['imports'], bench['import_problems'])
+
+    with open(args.output, 'w') as f:
+        json.dump(bench, f, indent=2)
+    print('Results written to %s' % args.output)
+
+    return bench
+
+if __name__ == '__main__':
+    main()
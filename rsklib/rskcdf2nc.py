@@ -3,64 +3,174 @@
 from __future__ import division, print_function
 
 import warnings
-import sys
+import os
 import argparse
-import yaml
-import xarray as xr
 import numpy as np
-sys.path.insert(0, '/Users/dnowacki/Documents/rsklib')
-sys.path.insert(0, '/Users/dnowacki/Documents/aqdlib')
-import rsklib
-import aqdlib
+from . import lazy_import, globalatts, profiling, ncio, rskrsk2cdf
+# xarray and netCDF4 are only imported when first used, and aqdlib only
+# when clipping
+xr = lazy_import('xarray')
+netCDF4 = lazy_import('netCDF4')
 
 
 
-def cdf_to_nc(metadata, atmpres=None):
+def cdf_to_nc(metadata, atmpres=None, chunks=None, append=False, encoding=None, zarr=None):
     """
-    Load raw .cdf file, trim, apply QAQC, and save to .nc
+    Load raw .cdf file, trim, apply QAQC, and save to .nc, optionally
+    appending only new bursts, reading lazily or using Zarr stores
     """
 
+    if append and zarr:
+        raise ValueError('appending is only supported for netCDF output')
+
     cdf_filename = metadata['filename'] + '-raw.cdf'
+    nc_filename = metadata['filename'] + 'b-cal.nc'
+
+    if chunks:
+        chunks = {'time': chunks}
+
+    ds = ncio.open_store(cdf_filename, zarr, chunks=chunks)
+
+    if append and os.path.exists(nc_filename):
+        if 'good_ens' in metadata and 'rsk_clipped' not in ds.attrs:
+            raise ValueError('cannot append using good_ens unless the data were clipped '
+                             'when read from the RSK file')
+
+        with netCDF4.Dataset(nc_filename) as nc:
+            since = np.datetime64(int(nc.getncattr('rsk_last_tstamp')), 'ms')
+        ds = ds.isel(time=np.flatnonzero(ds['time'].values > since))
+
+        if len(ds['time']) == 0:
+            print("No new bursts to append")
+            return ds
+
+        ds = xr_to_nc(ds, metadata, atmpres=atmpres)
 
-    ds = xr.open_dataset(cdf_filename, autoclose=True)
+        with profiling.stage('append', file=nc_filename, bursts=len(ds['time'])):
+            # time is EPIC days here, so match bursts on the CF time
+            ncio.append_netcdf(nc_filename, rename_time(ds), key='time_cf')
+        return ds
 
-    # trim data via one of two methods
-    ds = aqdlib.clip_ds(ds, metadata)
+    ds = xr_to_nc(ds, metadata, atmpres=atmpres)
+
+    # Write to .nc file
+    write_nc(ds, metadata, 'b-cal.nc', encoding=encoding, zarr=zarr)
+    return ds
+
+
+def xr_to_nc(ds, metadata, atmpres=None):
+    """
+    Trim, atmospherically correct and add times and attributes to a raw
+    Dataset, as loaded from the raw .cdf file or returned by rsk_to_xr
+    """
+
+    # trim data via one of two methods, unless rsk_to_xr already did so
+    # with the same values
+    clipped = 'rsk_clipped' in ds.attrs
+    if clipped and ds.attrs.get('rsk_clip_settings') == rskrsk2cdf.clip_settings(metadata):
+        print('Data already clipped using %s when read from RSK file' % ds.attrs['rsk_clipped'])
+    elif clipped and 'good_ens' in metadata:
+        # good_ens counts bursts from the start of the whole record
+        raise ValueError('data were clipped using %s when read from the RSK file; read it '
+                         'again to clip using good_ens' % ds.attrs.get('rsk_clip_settings'))
+    else:
+        import aqdlib
+        with profiling.stage('clip', bursts=len(ds['time'])) as record:
+            ds = aqdlib.clip_ds(ds, metadata)
+            record['kept'] = len(ds['time'])
+
+    # the per-burst diagnostics stay in the raw file only
+    ds = ds.drop_vars(rskrsk2cdf.diagnostic_variables(ds))
 
     if atmpres is not None:
-        print("Atmospherically correcting data")
+        ds = atmospheric_correction(ds, atmpres, max_gap=metadata.get('atmpres_max_gap'))
 
-        met = xr.open_dataset(atmpres, autoclose=True)
-        # need to save attrs before the subtraction, otherwise they are lost
-        # ds['P_1ac'] = ds['P_1'].copy(deep=True)
-        attrs = ds['P_1'].attrs
-        ds['P_1ac'] = ds['P_1'] - met['atmpres'] - met['atmpres'].offset
-        print('Correcting using offset of %f' % met['atmpres'].offset)
-        ds['P_1ac'].attrs = attrs
+    # assign min/max, computing them together so lazy data are only read once
+    with profiling.stage('stats', bytes=sum(ds[k].nbytes for k in ['P_1', 'P_1ac'] if k in ds)):
+        stats = ncio.variable_stats(ds, ['P_1', 'P_1ac'])
 
-    # assign min/max:
     for k in ['P_1', 'P_1ac']:
         if k in ds:
-            ds[k].attrs.update(minimum=ds[k].min().values, maximum=ds[k].max().values)
+            ds[k].attrs.update(minimum=stats[k]['min'], maximum=stats[k]['max'])
 
             # TODO: published dwave data are not in time, lon, lat, sample format...
             # shouldn't they be?
             # reshape and add lon and lat dimensions
 
-    ds = compute_time(ds)
+    with profiling.stage('epic_time'):
+        ds = compute_time(ds)
 
     ds = ds_add_attrs(ds, metadata)
 
-    ds = rsklib.write_metadata(ds, metadata)
+    ds = rskrsk2cdf.write_metadata(ds, metadata)
 
     ds = add_final_metadata(ds)
 
-    # Write to .nc file
-    print("Writing cleaned/trimmed data to .nc file")
-    write_nc(ds, metadata, 'b-cal.nc')
     return ds
 
 
+def atmospheric_correction(ds, atmpres, max_gap=None):
+    """
+    Subtract atmospheric pressure (and its offset attribute) from P_1 to
+    make P_1ac. The met record in the atmpres file (or an already opened
+    Dataset) is linearly interpolated to the burst times, so it does not
+    need to share their time base. Only the part of the met record
+    overlapping the bursts is read. Bursts outside the met record, or
+    between met samples more than max_gap seconds apart, are set to NaN.
+    """
+
+    if isinstance(atmpres, xr.Dataset):
+        with profiling.stage('atmospheric_correction', bursts=len(ds['time'])):
+            return _atmospheric_correction(ds, atmpres, max_gap)
+
+    with profiling.stage('atmospheric_correction', file=atmpres, bursts=len(ds['time'])):
+        return _atmospheric_correction(ds, xr.open_dataset(atmpres, autoclose=True), max_gap)
+
+
+def _atmospheric_correction(ds, met, max_gap):
+
+    if not met.indexes['time'].is_monotonic_increasing:
+        met = met.sortby('time')
+
+    metime = met['time'].values.astype('datetime64[ns]').view(np.int64)
+    bursttime = ds['time'].values.astype('datetime64[ns]').view(np.int64)
+
+    # window of the met record that brackets the bursts
+    start = max(np.searchsorted(metime, bursttime.min(), side='right') - 1, 0)
+    stop = min(np.searchsorted(metime, bursttime.max(), side='left') + 1, len(metime))
+    metime = metime[start:stop]
+    metpres = met['atmpres'][start:stop].values
+
+    if len(metime) == 0:
+        raise ValueError('atmospheric pressure record does not overlap the data')
+
+    # linear interpolation between the met samples either side of each burst
+    right = np.clip(np.searchsorted(metime, bursttime), 1, max(len(metime) - 1, 1))
+    left = right - 1
+    right = np.minimum(right, len(metime) - 1)
+    dt = metime[right] - metime[left]
+    weight = np.where(dt > 0, (bursttime - metime[left]) / np.maximum(dt, 1), 0)
+    pres = metpres[left] + weight * (metpres[right] - metpres[left])
+
+    bad = (bursttime < metime[0]) | (bursttime > metime[-1])
+    if max_gap is not None:
+        exact = (bursttime == metime[left]) | (bursttime == metime[right])
+        bad |= (dt > max_gap * 1e9) & ~exact
+    if np.any(bad):
+        print('No atmospheric pressure within range for %d of %d bursts' % (np.sum(bad), len(bad)))
+        pres[bad] = np.nan
+
+    offset = met['atmpres'].offset
+    print('Correcting using offset of %f' % offset)
+
+    # need to save attrs before the subtraction, otherwise they are lost
+    attrs = ds['P_1'].attrs
+    # the (time,) correction broadcasts along sample without being expanded
+    ds['P_1ac'] = ds['P_1'] - xr.DataArray(pres + offset, dims='time')
+    ds['P_1ac'].attrs = attrs
+
+    return ds
+
 def compute_time(RAW):
     """Compute Julian date and then time and time2 for use in netCDF file"""
 
@@ -77,37 +187,70 @@ def compute_time(RAW):
 
     return RAW
 
+def datetime_to_epic(times):
+    """
+    Convert datetime64 values (any shape) to EPIC time and time2, i.e. True
+    Julian Day and msec since 0:00 GMT, using integer arithmetic on the
+    nanoseconds since 1970 so there is no round-off
+    """
+
+    ns = np.asarray(times).astype('datetime64[ns]').view(np.int64)
+
+    # round to the nearest msec, then split into days and msec of day
+    ms = (ns + 500000) // 1000000
+    epic_time = (ms // 86400000 + 2440588).astype(np.int32)
+    epic_time2 = (ms % 86400000).astype(np.int32)
+
+    return epic_time, epic_time2
+
 def create_epic_time(RAW):
 
-    # create Julian date
-    RAW['jd'] = RAW['time'].to_dataframe().index.to_julian_date() + 0.5
+    epic_time, epic_time2 = datetime_to_epic(RAW['time'].values)
 
-    RAW['epic_time'] = np.floor(RAW['jd'])
-    if np.all(np.mod(RAW['epic_time'], 1) == 0): # make sure they are all integers, and then cast as such
-        RAW['epic_time'] = RAW['epic_time'].astype(np.int32)
-    else:
-        warnings.warn('not all EPIC time values are integers; '\
-                      'this will cause problems with time and time2')
+    # Julian date, starting at midnight
+    RAW['jd'] = xr.DataArray(epic_time + epic_time2 / 86400000, dims=RAW['time'].dims)
+
+    RAW['epic_time'] = xr.DataArray(epic_time, dims=RAW['time'].dims)
 
-    # TODO: Hopefully this is correct... roundoff errors on big numbers...
-    RAW['epic_time2'] = np.round((RAW['jd'] - np.floor(RAW['jd']))*86400000).astype(np.int32)
+    RAW['epic_time2'] = xr.DataArray(epic_time2, dims=RAW['time'].dims)
 
     return RAW
 
-def write_nc(ds, metadata, ext):
-    """Write cleaned and trimmed Dataset to .nc file"""
+def write_nc(ds, metadata, ext, compute=True, encoding=None, zarr=None):
+    """
+    Write cleaned and trimmed Dataset to .nc file, using the named profile in
+    ncio.ENCODINGS if encoding is given. Lazy data are computed and
+    written one chunk at a time; with compute=False the dask delayed object
+    doing so is returned instead. If zarr is 'dir' or 'zip', a Zarr store
+    is written in place of the .nc file.
+    """
 
     nc_filename = metadata['filename'] + ext
 
-    # new version of xarray seems to support renaming time in this manner
-    ds.rename({'time': 'time_cf',
-               'epic_time': 'time',
-               'epic_time2': 'time2'},
-               inplace=True)
-    ds.swap_dims({'time_cf': 'time'}, inplace=True)
+    ds = rename_time(ds)
+
+    if zarr:
+        return ncio.write_zarr(ds, nc_filename, encoding=encoding, zarr=zarr)
+
+    ds, encoding = ncio.netcdf_encoding(ds, encoding)
 
-    # TODO: unlimited_dims='time' doesn't seem to work
-    ds.to_netcdf(nc_filename, engine='netcdf4')
+    # unlimited_dims needs a list; a bare 'time' is taken as four dimensions
+    if not compute:
+        return ds.to_netcdf(nc_filename, engine='netcdf4', compute=False,
+                            unlimited_dims=['time'], encoding=encoding)
+
+    with profiling.stage('write', file=nc_filename, bytes=ds.nbytes) as record:
+        ds.to_netcdf(nc_filename, engine='netcdf4', unlimited_dims=['time'], encoding=encoding)
+        record['file_bytes'] = ncio.file_size(nc_filename)
+
+
+def rename_time(ds):
+    """Use EPIC time as the time dimension, keeping CF time as time_cf"""
+
+    # new version of xarray seems to support renaming time in this manner
+    return ds.rename({'time': 'time_cf',
+                      'epic_time': 'time',
+                      'epic_time2': 'time2'}).swap_dims({'time_cf': 'time'})
 
 
 def add_final_metadata(ds):
@@ -151,16 +294,30 @@ def ds_add_attrs(ds, metadata):
 
 
 def main():
+    import yaml
 
     parser = argparse.ArgumentParser(description='Convert raw RBR d|wave .cdf format to processed .nc files')
     parser.add_argument('gatts', help='path to global attributes file (gatts formatted)')
     parser.add_argument('config', help='path to ancillary config file (YAML formatted)')
     parser.add_argument('--atmpres', help='path to cdf file containing atmopsheric pressure data')
+    parser.add_argument('--chunks', type=int,
+                        help='process this many bursts at a time instead of loading the whole file (requires dask)')
+    parser.add_argument('--append', action='store_true',
+                        help='only process bursts added to the raw .cdf file since the .nc file was written and append them to it')
+    parser.add_argument('--encoding', choices=sorted(ncio.ENCODINGS),
+                        help='compression and pressure dtype profile for the .nc file (default: uncompressed float64)')
+    parser.add_argument('--zarr', choices=['dir', 'zip'],
+                        help='read and write Zarr stores (directories or zip files) instead of .cdf and .nc files (requires zarr and dask)')
+
+    parser.add_argument('--metrics', help='file to append the time, throughput and peak memory of each stage to as JSON lines')
+    parser.add_argument('--profile', help='directory in which to write cProfile stats for each stage')
 
     args = parser.parse_args()
 
+    profiling.configure(metrics=args.metrics, profile=args.profile)
+
     # initialize metadata from the globalatts file
-    metadata = rsklib.read_globalatts(args.gatts)
+    metadata = globalatts.read_globalatts(args.gatts)
 
     # Add additional metadata from metadata config file
     config = yaml.safe_load(open(args.config))
@@ -169,9 +326,11 @@ def main():
         metadata[k] = config[k]
 
     if args.atmpres:
-        ds = rsklib.cdf_to_nc(metadata, atmpres=args.atmpres)
+        ds = cdf_to_nc(metadata, atmpres=args.atmpres, chunks=args.chunks, append=args.append,
+                       encoding=args.encoding, zarr=args.zarr)
     else:
-        ds = rsklib.cdf_to_nc(metadata)
+        ds = cdf_to_nc(metadata, chunks=args.chunks, append=args.append, encoding=args.encoding,
+                       zarr=args.zarr)
 
     return ds
 
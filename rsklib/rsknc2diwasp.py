@@ -1,64 +1,181 @@
 #!/usr/bin/env python
 
 from __future__ import division, print_function
-import sys
-sys.path.insert(0, '/Users/dnowacki/Documents/rsklib')
-import rsklib
-import netCDF4
-import xarray as xr
+import numpy as np
+from . import lazy_import, globalatts, profiling, waves, ncio, rskrsk2cdf, rskcdf2nc
+# xarray is only imported when first used
+xr = lazy_import('xarray')
 
 
-def nc_to_diwasp(metadata):
+def nc_to_diwasp(metadata, native=False, chunks=None, encoding=None, zarr=None):
+    """
+    Load b-cal.nc, add wave statistics and spectra (from diwasp.nc, or
+    computed from the pressure data if native is True), apply QAQC, and
+    save to s-a.nc
+    """
+
+    if chunks:
+        chunks = {'time': chunks}
 
-    ds = xr.open_dataset(metadata['filename'] + 'b-cal.nc', autoclose=True, decode_times=False)
+    ds = ncio.open_store(metadata['filename'] + 'b-cal.nc', zarr, decode_times=False,
+                         chunks=chunks)
     ds['time'] = ds['time_cf']
-    ds = ds.drop(['time_cf', 'time2'])
+    ds = ds.drop_vars(['time_cf', 'time2'])
     ds = xr.decode_cf(ds, decode_times=True)
 
-    ds = rsklib.rskcdf2nc.create_epic_time(ds)
+    ds = xr_to_diwasp(ds, metadata, native=native)
+
+    rskcdf2nc.write_nc(ds, metadata, 's-a.nc', encoding=encoding, zarr=zarr)
+
+    return ds
 
-    mat = xr.open_dataset(metadata['filename'][:-2] + 'diwasp.nc', autoclose=True)
 
-    for k in ['wp_peak', 'wh_4061', 'wp_4060']:
-        ds[k] = xr.DataArray(mat[k], dims='time')
+def xr_to_diwasp(ds, metadata, native=False):
+    """
+    Add wave statistics and spectra to a Dataset of burst pressure data, as
+    loaded from b-cal.nc or returned by rskcdf2nc.xr_to_nc, drop the burst
+    data and apply QAQC
+    """
 
-    ds['frequency'] = xr.DataArray(mat['frequency'], dims=('frequency'))
+    ds = rskcdf2nc.create_epic_time(ds)
 
-    ds['pspec'] = xr.DataArray(mat['pspec'], dims=('time', 'frequency'))
+    if native:
+        ds = make_waves(ds, metadata)
+    else:
+        mat = xr.open_dataset(metadata['filename'][:-2] + 'diwasp.nc', autoclose=True)
 
-    ds, metadata = create_water_depth(ds, metadata)
+        for k in ['wp_peak', 'wh_4061', 'wp_4060']:
+            ds[k] = xr.DataArray(mat[k], dims='time')
 
-    ds = ds.drop(['P_1', 'P_1ac', 'sample'])
+        ds['frequency'] = xr.DataArray(mat['frequency'], dims=('frequency'))
 
-    ds = trim_max_wp(ds, metadata)
+        ds['pspec'] = xr.DataArray(mat['pspec'], dims=('time', 'frequency'))
 
-    ds = trim_min_wh(ds, metadata)
+    if 'wave_frequency_band' in metadata or 'wave_frequency_grid' in metadata:
+        ds = recompute_waves(ds, metadata)
 
-    ds = trim_wp_ratio(ds, metadata)
+    ds, metadata = create_water_depth(ds, metadata)
+
+    # drop the burst data (P_1, P_1ac and any other channels)
+    ds = ds.drop_vars([k for k in ds.variables if 'sample' in ds[k].dims])
+
+    ds = apply_qc(ds, metadata)
 
     # Add attrs
     ds = ds_add_attrs(ds, metadata)
 
-    ds = rsklib.write_metadata(ds, metadata)
+    ds = rskrsk2cdf.write_metadata(ds, metadata)
+
+    return ds
+
+
+def make_waves(ds, metadata):
+    """
+    Compute pressure-derived wave spectra and statistics for all bursts at
+    once, in place of scripts/rundiwasp.m
+    """
+
+    if 'P_1ac' in ds:
+        pres = ds['P_1ac']
+    else:
+        print('No atmospherically corrected pressure; computing waves from P_1')
+        pres = ds['P_1']
+
+    fs = 1 / ds.attrs['sample_interval']
+    height = metadata['initial_instrument_height']
+
+    frequency = waves.spectral_frequency(pres.shape[-1], fs)
+
+    with profiling.stage('waves', bursts=pres.shape[0], bytes=pres.nbytes):
+        if pres.chunks is not None:
+            # keep the spectra lazy, one time chunk of bursts at a time
+            data = pres.data.rechunk({1: -1})
+            pspec = data.map_blocks(waves.surface_spectra, fs, height,
+                                    chunks=(data.chunks[0], (len(frequency),)),
+                                    dtype=float)
+            wh, wp_peak, wp_mean = [pspec.map_blocks(lambda s, n=n: waves.wave_statistics(frequency, s)[n],
+                                                     drop_axis=1, dtype=float)
+                                    for n in range(3)]
+        else:
+            pspec = waves.surface_spectra(pres.values, fs, height)
+            wh, wp_peak, wp_mean = waves.wave_statistics(frequency, pspec)
+
+    ds['wh_4061'] = xr.DataArray(wh, dims='time')
+    ds['wp_peak'] = xr.DataArray(wp_peak, dims='time')
+    ds['wp_4060'] = xr.DataArray(wp_mean, dims='time')
+
+    ds['frequency'] = xr.DataArray(frequency, dims=('frequency'))
 
-    rsklib.rskcdf2nc.write_nc(ds, metadata, 's-a.nc')
+    ds['pspec'] = xr.DataArray(pspec, dims=('time', 'frequency'))
 
     return ds
 
+def recompute_waves(ds, metadata):
+    """
+    Recompute the wave statistics from pspec, so changing the frequency
+    band does not mean recomputing the spectra. If wave_frequency_grid
+    ([start, stop, step] in Hz) is in the metadata, pspec is first
+    rebinned to that grid. The spectral moments m0, m1 and m2 and
+    wh_4061, wp_peak and wp_4060 are then computed from the bins within
+    wave_frequency_band ([fmin, fmax] in Hz, either of which may be null).
+    """
+
+    fmin, fmax = metadata.get('wave_frequency_band', [None, None])
+
+    frequency = ds['frequency'].values
+    pspec = ds['pspec'].data
+
+    with profiling.stage('recompute_waves', bursts=ds.sizes['time'], fmin=fmin, fmax=fmax):
+        if 'wave_frequency_grid' in metadata:
+            start, stop, step = metadata['wave_frequency_grid']
+            grid = start + step * np.arange(int(round((stop - start) / step)) + 1)
+            if ds['pspec'].chunks is not None:
+                # bind frequency now, as it is replaced by the grid before computing
+                regrid = lambda s, f=frequency: waves.regrid_spectra(f, s, grid)
+                pspec = pspec.rechunk({1: -1}).map_blocks(regrid, chunks=(pspec.chunks[0], (len(grid),)),
+                                                          dtype=float)
+            else:
+                pspec = waves.regrid_spectra(frequency, pspec, grid)
+            frequency = grid
+            ds = ds.drop_vars(['pspec', 'frequency'])
+            ds['frequency'] = xr.DataArray(frequency, dims='frequency')
+            ds['pspec'] = xr.DataArray(pspec, dims=('time', 'frequency'))
+
+        if ds['pspec'].chunks is not None:
+            # one time chunk of bursts at a time, as in make_waves
+            data = pspec.rechunk({1: -1})
+            stats = dict((k, data.map_blocks(lambda s, k=k: waves.band_statistics(frequency, s, fmin, fmax)[k],
+                                             drop_axis=1, dtype=float))
+                         for k in ['m0', 'm1', 'm2', 'wh', 'wp_peak', 'wp_mean'])
+        else:
+            stats = waves.band_statistics(frequency, pspec, fmin, fmax)
+
+    for k, name in [('m0', 'm0'), ('m1', 'm1'), ('m2', 'm2'), ('wh', 'wh_4061'), ('wp_peak', 'wp_peak'),
+                    ('wp_mean', 'wp_4060')]:
+        ds[name] = xr.DataArray(stats[k], dims='time')
+
+    lo = '0 Hz' if fmin is None else '%g Hz' % fmin
+    hi = 'the Nyquist frequency' if fmax is None else '%g Hz' % fmax
+    for k in ['wh_4061', 'wp_peak', 'wp_4060']:
+        ds[k].attrs['note'] = 'Computed from pspec between %s and %s. ' % (lo, hi)
+
+    return ds
 
 def create_water_depth(VEL, metadata):
     """Create water_depth variable"""
 
     if 'initial_instrument_height' in metadata:
         if 'P_1ac' in VEL:
-            metadata['nominal_instrument_depth'] = VEL['P_1ac'].mean().values
+            stats = ncio.variable_stats(VEL, ['P_1ac'])
+            metadata['nominal_instrument_depth'] = stats['P_1ac']['mean']
             VEL['water_depth'] = metadata['nominal_instrument_depth']
             wdepth = metadata['nominal_instrument_depth'] + metadata['initial_instrument_height']
             metadata['WATER_DEPTH_source'] = 'water depth = MSL from pressure sensor,'\
                                              ' atmospherically corrected'
             metadata['WATER_DEPTH_datum'] = 'MSL'
         elif 'P_1' in VEL:
-            metadata['nominal_instrument_depth'] = VEL['P_1'].mean().values
+            stats = ncio.variable_stats(VEL, ['P_1'])
+            metadata['nominal_instrument_depth'] = stats['P_1']['mean']
             VEL['water_depth'] = metadata['nominal_instrument_depth']
             wdepth = metadata['nominal_instrument_depth'] + metadata['initial_instrument_height']
             metadata['WATER_DEPTH_source'] = 'water depth = MSL from pressure sensor'
@@ -77,66 +194,127 @@ def create_water_depth(VEL, metadata):
 
     return VEL, metadata
 
-def trim_max_wp(ds, metadata):
+def read_qc_rules(metadata):
     """
-    QA/QC
-    Trim wave data based on maximum wave period as specified in metadata
+    Build the list of QA/QC rules from the metadata. The maximum_wp,
+    minimum_wh and wp_ratio keys become rules, followed by any listed under
+    qc_rules, each of which is a dict such as
+
+        {'name': 'maximum_wh', 'variables': ['wh_4061'], 'max': 5,
+         'targets': ['wh_4061', 'pspec']}
+
+    A rule passes where all its variables are below max and/or above min,
+    or, if it gives a pair of variables as 'ratio' instead, where their
+    ratio is. Data fail where they are NaN, as with .where. Where a rule
+    fails its targets (by default its variables) are filled.
     """
 
+    rules = []
+
     if 'maximum_wp' in metadata:
         print('Trimming using maximum period of %f seconds'
             % metadata['maximum_wp'])
-        for var in ['wp_peak', 'wp_4060']:
-            ds[var] = ds[var].where((ds['wp_peak'] < metadata['maximum_wp']) &
-                (ds['wp_4060'] < metadata['maximum_wp']))
+        rules.append({'name': 'maximum_wp',
+                      'variables': ['wp_peak', 'wp_4060'],
+                      'max': metadata['maximum_wp']})
+
+    if 'minimum_wh' in metadata:
+        print('Trimming using minimum wave height of %f m'
+            % metadata['minimum_wh'])
+        rules.append({'name': 'minimum_wh',
+                      'variables': ['wh_4061'],
+                      'min': metadata['minimum_wh'],
+                      'targets': ['wp_peak', 'wp_4060', 'wh_4061']})
 
-        for var in ['wp_peak', 'wp_4060']:
-            notetxt = 'Values filled where wp_peak, wp_4060 >= %f' % metadata['maximum_wp'] + '. '
+    if 'wp_ratio' in metadata:
+        print('Trimming using maximum ratio of wp_peak to wp_4060 of %f'
+            % metadata['wp_ratio'])
+        rules.append({'name': 'wp_ratio',
+                      'ratio': ['wp_peak', 'wp_4060'],
+                      'max': metadata['wp_ratio']})
 
-            if 'note' in ds[var].attrs:
-                ds[var].attrs['note'] = notetxt + ds[var].attrs['note']
-            else:
-                ds[var].attrs.update({'note': notetxt})
+    for rule in metadata.get('qc_rules', []):
+        print('Trimming using %s' % rule['name'])
+        rules.append(dict(rule))
 
-    return ds
+    for rule in rules:
+        if 'min' not in rule and 'max' not in rule:
+            raise ValueError('QA/QC rule %s needs a min or max' % rule['name'])
+        rule.setdefault('targets', rule.get('variables', rule.get('ratio')))
 
+    return rules
 
-def trim_min_wh(ds, metadata):
-    """
-    QA/QC
-    Trim wave data based on minimum wave height as specified in metadata
-    """
 
-    if 'minimum_wh' in metadata:
-        print('Trimming using minimum wave height of %f m'
-            % metadata['minimum_wh'])
-        ds = ds.where(ds['wh_4061'] > metadata['minimum_wh'])
+def qc_note(rule):
+    """Describe the values a rule fills, for the note attribute"""
 
-        for var in ['wp_peak', 'wp_4060', 'wh_4061']:
-            notetxt = 'Values filled where wh_4061 <= %f' % metadata['minimum_wh'] + '. '
+    if 'ratio' in rule:
+        name = ':'.join(rule['ratio'])
+    else:
+        name = ', '.join(rule['variables'])
 
-            if 'note' in ds[var].attrs:
-                ds[var].attrs['note'] = notetxt + ds[var].attrs['note']
-            else:
-                ds[var].attrs.update({'note': notetxt})
+    clauses = []
+    if 'max' in rule:
+        clauses.append('%s >= %f' % (name, rule['max']))
+    if 'min' in rule:
+        clauses.append('%s <= %f' % (name, rule['min']))
 
-    return ds
+    return 'Values filled where ' + ' or '.join(clauses) + '. '
 
 
-def trim_wp_ratio(ds, metadata):
+def apply_qc(ds, metadata):
     """
     QA/QC
-    Trim wave data based on maximum ratio of wp_peak to wp_4060
+    Evaluate all the rules from read_qc_rules on the unfilled data, store
+    which ones failed for each burst as bits of qc_flag, and then fill each
+    target variable once where any of its rules failed
     """
 
-    if 'wp_ratio' in metadata:
-        print('Trimming using maximum ratio of wp_peak to wp_4060 of %f'
-            % metadata['wp_ratio'])
-        for var in ['wp_peak', 'wp_4060']:
-            ds[var] = ds[var].where(ds['wp_peak']/ds['wp_4060'] < metadata['wp_ratio'])
+    rules = read_qc_rules(metadata)
+    if not rules:
+        return ds
+
+    with profiling.stage('qc', rules=len(rules)):
+        return _apply_qc(ds, rules)
+
 
-        for var in ['wp_peak', 'wp_4060']:
-            notetxt = 'Values filled where wp_peak:wp_4060 >= %f' % metadata['wp_ratio'] + '. '
+def _apply_qc(ds, rules):
+
+    flags = 0
+    for bit, rule in enumerate(rules):
+        if 'ratio' in rule:
+            values = [ds[rule['ratio'][0]] / ds[rule['ratio'][1]]]
+        else:
+            values = [ds[k] for k in rule['variables']]
+
+        ok = True
+        for v in values:
+            if 'max' in rule:
+                ok = ok & (v < rule['max'])
+            if 'min' in rule:
+                ok = ok & (v > rule['min'])
+
+        flags = flags + (~ok).astype('int32') * 2**bit
+
+    # the flags should not inherit the attributes of the variables tested
+    flags.attrs = {}
+    ds['qc_flag'] = flags
+    ds['qc_flag'].attrs.update({'long_name': 'QA/QC flags',
+        'flag_masks': [2**bit for bit in range(len(rules))],
+        'flag_meanings': ' '.join(rule['name'] for rule in rules)})
+
+    targets = []
+    for rule in rules:
+        targets.extend(k for k in rule['targets'] if k not in targets)
+
+    for var in targets:
+        mask = sum(2**bit for bit, rule in enumerate(rules) if var in rule['targets'])
+        ds[var] = ds[var].where(ds['qc_flag'] & mask == 0)
+
+    # the latest rule's note comes first, as when each rule filled in turn
+    for rule in rules:
+        for var in rule['targets']:
+            notetxt = qc_note(rule)
 
             if 'note' in ds[var].attrs:
                 ds[var].attrs['note'] = notetxt + ds[var].attrs['note']
@@ -198,10 +376,18 @@ def ds_add_attrs(ds, metadata):
     ds['frequency'].attrs.update({'long_name': 'Frequency',
         'units': 'Hz'})
 
+    # spectral moments, if recompute_waves was used
+    for k, name, units in [('m0', 'Zeroth', 'm^2'), ('m1', 'First', 'm^2/s'), ('m2', 'Second', 'm^2/s^2')]:
+        if k in ds:
+            ds[k].attrs.update({'long_name': '%s moment of the wave energy spectrum' % name,
+                'units': units})
+
+    stats = ncio.variable_stats(ds, ['wp_peak', 'wh_4061', 'wp_4060', 'pspec', 'water_depth'])
+
     for var in ['wp_peak', 'wh_4061', 'wp_4060', 'pspec', 'water_depth']:
         add_attributes(ds[var], metadata, ds.attrs)
-        ds[var].attrs.update({'minimum': ds[var].min().values,
-            'maximum': ds[var].max().values})
+        ds[var].attrs.update({'minimum': stats[var]['min'],
+            'maximum': stats[var]['max']})
 
     return ds
 
@@ -212,11 +398,24 @@ def main():
     parser = argparse.ArgumentParser(description='Convert processed .nc files using DIWASP')
     parser.add_argument('gatts', help='path to global attributes file (gatts formatted)')
     parser.add_argument('config', help='path to ancillary config file (YAML formatted)')
+    parser.add_argument('--native', action='store_true',
+                        help='compute waves from the pressure data instead of reading diwasp.nc')
+    parser.add_argument('--chunks', type=int,
+                        help='process this many bursts at a time instead of loading the whole file (requires dask)')
+    parser.add_argument('--encoding', choices=sorted(ncio.ENCODINGS),
+                        help='compression profile for the .nc file (default: uncompressed)')
+    parser.add_argument('--zarr', choices=['dir', 'zip'],
+                        help='read and write Zarr stores (directories or zip files) instead of .nc files (requires zarr and dask)')
+
+    parser.add_argument('--metrics', help='file to append the time, throughput and peak memory of each stage to as JSON lines')
+    parser.add_argument('--profile', help='directory in which to write cProfile stats for each stage')
 
     args = parser.parse_args()
 
+    profiling.configure(metrics=args.metrics, profile=args.profile)
+
     # initialize metadata from the globalatts file
-    metadata = rsklib.read_globalatts(args.gatts)
+    metadata = globalatts.read_globalatts(args.gatts)
 
     # Add additional metadata from metadata config file
     config = yaml.safe_load(open(args.config))
@@ -224,7 +423,8 @@ def main():
     for k in config:
         metadata[k] = config[k]
 
-    ds = nc_to_diwasp(metadata)
+    ds = nc_to_diwasp(metadata, native=args.native, chunks=args.chunks, encoding=args.encoding,
+                      zarr=args.zarr)
 
     return ds
 
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+from __future__ import division, print_function
+
+import argparse
+from . import globalatts, profiling, ncio, rskrsk2cdf, rskcdf2nc, rsknc2diwasp
+
+
+def rsk_to_waves(metadata, atmpres=None, native=True, write_raw=False, write_cal=False, encoding=None,
+                 zarr=None, workers=None, processes=False):
+    """
+    Run the whole processing chain in memory, from the RSK file to the wave
+    statistics in s-a.nc, passing the Dataset from one stage to the next.
+    The -raw.cdf and b-cal.nc files are only written if requested. All files
+    are written with the encoding profile named by encoding, and as Zarr
+    stores if zarr is 'dir' or 'zip'. See rskrsk2cdf.read_rsk for workers
+    and processes.
+    """
+
+    RAW, metadata = rskrsk2cdf.rsk_to_xr(metadata, workers=workers, processes=processes)
+
+    if write_raw:
+        rskrsk2cdf.xr_to_cdf(RAW, metadata, encoding=encoding, zarr=zarr)
+
+    ds = rskcdf2nc.xr_to_nc(RAW, metadata, atmpres=atmpres)
+
+    if write_cal:
+        rskcdf2nc.write_nc(ds, metadata, 'b-cal.nc', encoding=encoding, zarr=zarr)
+
+    ds = rsknc2diwasp.xr_to_diwasp(ds, metadata, native=native)
+
+    rskcdf2nc.write_nc(ds, metadata, 's-a.nc', encoding=encoding, zarr=zarr)
+
+    return ds
+
+
+def main():
+    import yaml
+
+    parser = argparse.ArgumentParser(description='Process RBR d|wave files (.rsk) to wave statistics in one step. Run this script from the directory containing d|wave files')
+    parser.add_argument('gatts', help='path to global attributes file (gatts formatted)')
+    parser.add_argument('config', help='path to ancillary config file (YAML formatted)')
+    parser.add_argument('--atmpres', help='path to cdf file containing atmopsheric pressure data')
+    parser.add_argument('--diwasp', dest='native', action='store_false',
+                        help='read waves from diwasp.nc instead of computing them from the pressure data')
+    parser.add_argument('--write-raw', action='store_true', help='also write the raw .cdf file')
+    parser.add_argument('--write-cal', action='store_true', help='also write the b-cal.nc file')
+    parser.add_argument('--encoding', choices=sorted(ncio.ENCODINGS),
+                        help='compression and pressure dtype profile for the output files (default: uncompressed float64)')
+    parser.add_argument('--zarr', choices=['dir', 'zip'],
+                        help='write Zarr stores (directories or zip files) instead of netCDF files (requires zarr and dask)')
+
+    parser.add_argument('--workers', type=int,
+                        help='read the RSK file in this many partitions at once')
+    parser.add_argument('--processes', action='store_true',
+                        help='use worker processes rather than threads for --workers, which scales better')
+    parser.add_argument('--metrics', help='file to append the time, throughput and peak memory of each stage to as JSON lines')
+    parser.add_argument('--profile', help='directory in which to write cProfile stats for each stage')
+
+    args = parser.parse_args()
+
+    profiling.configure(metrics=args.metrics, profile=args.profile)
+
+    # initialize metadata from the globalatts file
+    metadata = globalatts.read_globalatts(args.gatts)
+
+    # Add additional metadata from metadata config file
+    config = yaml.safe_load(open(args.config))
+
+    for k in config:
+        metadata[k] = config[k]
+
+    ds = rsk_to_waves(metadata, atmpres=args.atmpres, native=args.native,
+                      write_raw=args.write_raw, write_cal=args.write_cal, encoding=args.encoding,
+                      zarr=args.zarr, workers=args.workers, processes=args.processes)
+
+    return ds
+
+if __name__ == '__main__':
+    main()
@@ -3,50 +3,630 @@
 from __future__ import division, print_function
 
 import sqlite3
-import inspect
-import platform
 import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import warnings
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.request import pathname2url
 import numpy as np
-import xarray as xr
-import pandas as pd
-import netCDF4
+from . import lazy_import, globalatts, profiling, ncio
+# xarray, pandas and netCDF4 are only imported when first used
+xr = lazy_import('xarray')
+pd = lazy_import('pandas')
+netCDF4 = lazy_import('netCDF4')
 
+# number of rows to fetch from burstdata at a time
+CHUNKSIZE = 100000
 
-def rsk_to_cdf(metadata):
+# fewest rows worth giving each worker of read_burstdata_parallel; below
+# this the cost of opening connections outweighs reading in parallel
+PARTITION_ROWS = 100000
+
+# default size limit (bytes) of the RSK array cache, and a version number
+# to change whenever the cached arrays change
+CACHE_SIZE = 10 * 1024**3
+CACHE_VERSION = 3
+
+# metadata that read_rsk derives from the RSK file, saved with the cached
+# arrays since a cache hit skips read_rsk
+CACHE_METADATA = ['samples_per_burst', 'sample_interval', 'burst_interval', 'burst_length',
+                  'serial_number', 'INST_TYPE', 'rsk_clipped', 'rsk_clip_settings', 'rsk_sort',
+                  'rsk_last_tstamp', 'rsk_last_burst']
+
+# number of neighbouring bursts whose first sample times are used to follow
+# slow clock drift when segmenting bursts
+DRIFT_BURSTS = 9
+
+# EPIC variable name, code and long_name for channels we know about, keyed
+# on the longName in the RSK channels table
+EPIC_CHANNELS = {'Pressure': ('P_1', 1, 'Pressure'),
+                 'Temperature': ('T_28', 28, 'Temperature'),
+                 'Conductivity': ('C_50', 50, 'Conductivity')}
+
+# samples further than this many robust standard deviations (1.4826 times
+# the median absolute deviation) from their burst median count as spikes
+SPIKE_THRESHOLD = 6
+
+# statistics burst_diagnostics computes, stored by rsk_to_xr as <name>_<statistic>
+DIAGNOSTICS = ['mean', 'std', 'spikes', 'flatline']
+
+def rsk_to_cdf(metadata, chunksize=None, clip=True, cache=None, append=False, encoding=None,
+               zarr=None, workers=None, processes=False):
     """
-    Main function to load data from RSK file and save to raw .CDF
+    Main function to load data from RSK file and save to raw .CDF. If append
+    is True and the raw .CDF already exists, only the complete bursts
+    recorded since it was last written are read and appended to it.
+    encoding is the name of a profile in ncio.ENCODINGS. If zarr is 'dir' or
+    'zip', a Zarr store is written instead of the .CDF. See read_rsk for
+    workers and processes.
     """
 
-    RAW, metadata = rsk_to_xr(metadata)
+    cdf_filename = metadata['filename'] + '-raw.cdf'
+
+    if append and zarr:
+        raise ValueError('appending is only supported for netCDF output')
+
+    if append and os.path.exists(cdf_filename):
+        with netCDF4.Dataset(cdf_filename) as nc:
+            since = int(nc.getncattr('rsk_last_tstamp'))
+            if 'rsk_last_burst' in nc.ncattrs():
+                metadata['rsk_last_burst'] = int(nc.getncattr('rsk_last_burst'))
+
+        RAW, metadata = rsk_to_xr(metadata, chunksize=chunksize, clip=clip, since=since,
+                                  workers=workers, processes=processes)
+
+        if len(RAW['time']) == 0:
+            print("No new bursts to append")
+        else:
+            with profiling.stage('append', file=cdf_filename, bursts=len(RAW['time'])):
+                ncio.append_netcdf(cdf_filename, RAW)
 
-    print("Writing to raw netCDF")
-    xr_to_cdf(RAW, metadata)
+        return RAW, metadata
 
-    print("Done")
+    if append:
+        # leave off a burst that is still being recorded
+        RAW, metadata = rsk_to_xr(metadata, chunksize=chunksize, clip=clip, since=0,
+                                  workers=workers, processes=processes)
+    else:
+        RAW, metadata = rsk_to_xr(metadata, chunksize=chunksize, clip=clip, cache=cache,
+                                  workers=workers, processes=processes)
+
+    xr_to_cdf(RAW, metadata, encoding=encoding, zarr=zarr)
 
     return RAW, metadata
 
-def init_connection(rskfile):
-    """Initialize an sqlite3 connection and return a cursor"""
+def init_connection(rskfile, readonly=False, immutable=False):
+    """
+    Initialize an sqlite3 connection and return a cursor. A readonly
+    connection never writes to the file, so it is safe to use while the
+    logger software is still writing to it (including in WAL mode). An
+    immutable connection is also read-only, and skips all locking on the
+    assumption that nothing else is changing the file, which makes many
+    concurrent readers cheaper; never use it on a live file.
+    """
 
-    conn = sqlite3.connect(rskfile)
+    if readonly or immutable:
+        uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(rskfile))
+        if immutable:
+            uri += '&immutable=1'
+        conn = sqlite3.connect(uri, uri=True)
+    else:
+        conn = sqlite3.connect(rskfile)
     return conn.cursor()
 
-def rsk_to_xr(metadata):
+def has_tstamp_index(conn):
+    """Check whether burstdata has an index on tstamp for range queries"""
+
+    for idx in conn.execute("PRAGMA index_list(burstdata)").fetchall():
+        cols = conn.execute("PRAGMA index_info('%s')" % idx[1]).fetchall()
+        if cols and cols[0][2] == 'tstamp':
+            return True
+
+    return False
+
+def clip_tstamps(conn, metadata):
     """
-    Load data from RSK file and generate an xarray Dataset
+    Convert the clipping metadata used by aqdlib.clip_ds (good_ens, or
+    Deployment_date and Recovery_date) to a burst-aligned [start, stop) range
+    of tstamps in ms. Returns None if no clipping values are specified.
     """
 
-    rskfile = metadata['basefile'] + '.rsk'
+    rep = metadata['burst_interval'] * 1000
+    # put the range boundaries halfway through the idle time between bursts
+    # so small clock drift does not split a burst
+    guard = max(rep - metadata['burst_length'] * 1000,
+                metadata['sample_interval'] * 1000) / 2
+
+    t0, t1 = conn.execute("SELECT MIN(tstamp), MAX(tstamp) FROM burstdata").fetchone()
+    if t0 is None:
+        return None
+
+    if 'good_ens' in metadata:
+        print('Clipping data using good_ens')
+        # good_ens indexes the bursts present, as clip_ds does, so segment
+        # the tstamps alone to find where each burst starts
+        t = np.fromiter((r[0] for r in conn.execute("SELECT tstamp FROM burstdata")), np.int64)
+        t.sort()
+        starts = segment_bursts({'unixtime': t}, metadata['samples_per_burst'],
+                                metadata['sample_interval'] * 1000, rep)['unixtime']
+        first, last = slice(*metadata['good_ens'][:2]).indices(len(starts))[:2]
+        if last <= first:
+            return t0, t0
+        start = int(np.floor(starts[first] - guard))
+        stop = int(np.floor(starts[last] - guard)) if last < len(starts) else t1 + 1
+        return start, stop
+    elif 'Deployment_date' in metadata and 'Recovery_date' in metadata:
+        print('Clipping data using Deployment_date and Recovery_date')
+        # keep bursts starting within [Deployment_date, Recovery_date], as
+        # ds.sel(time=slice(...)) does on the burst start times
+        deployment = pd.Timestamp(metadata['Deployment_date']).value // 10**6
+        recovery = pd.Timestamp(metadata['Recovery_date']).value // 10**6
+        first = int(np.ceil((deployment - t0) / rep))
+        last = int(np.floor((recovery - t0) / rep)) + 1
+    else:
+        return None
+
+    start = int(np.floor(t0 + max(first, 0) * rep - guard))
+    stop = int(np.floor(t0 + last * rep - guard))
+
+    return start, stop
+
+def clip_settings(metadata):
+    """
+    The clipping values in metadata used by clip_tstamps, as a JSON string
+    stored with the data so they can be compared later
+    """
+
+    if 'good_ens' in metadata:
+        keys = ['good_ens']
+    elif 'Deployment_date' in metadata and 'Recovery_date' in metadata:
+        keys = ['Deployment_date', 'Recovery_date']
+    else:
+        return None
+
+    return json.dumps({k: metadata[k] for k in keys}, sort_keys=True, default=str)
+
+def read_channels(conn, metadata):
+    """
+    Find the channels stored in burstdata from the RSK channels table and
+    map them to EPIC variables. If metadata['channels'] is given, only the
+    channels whose longName, shortName or variable name it lists are kept.
+    Returns a list of (column, variable name, attrs) tuples.
+    """
+
+    columns = [c[1] for c in conn.execute("PRAGMA table_info(burstdata)").fetchall()]
+
+    tables = [t[0] for t in conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()]
+    if 'channels' in tables:
+        rows = conn.execute("SELECT channelID, shortName, longName, units FROM channels "
+                            "ORDER BY channelID").fetchall()
+    else:
+        # d|wave files without a channels table only record pressure
+        rows = [(1, 'pres', 'Pressure', 'dbar')]
+
+    channels = []
+    names = set()
+    counts = Counter()
+    for channelid, shortname, longname, units in rows:
+        column = 'channel%02d' % channelid
+        if column not in columns: # derived channels are not stored
+            continue
+
+        if longname in EPIC_CHANNELS:
+            name, epic_code, long_name = EPIC_CHANNELS[longname]
+            attrs = {'long_name': long_name, 'epic_code': epic_code}
+        else:
+            name = shortname
+            attrs = {'long_name': longname}
+        # a second channel of the same kind gets a numbered name; channels
+        # are numbered before filtering so names don't depend on the filter
+        base = name
+        counts[base] += 1
+        if counts[base] > 1:
+            name = '%s_%d' % (base, counts[base])
+        while name in names:
+            counts[base] += 1
+            name = '%s_%d' % (base, counts[base])
+        names.add(name)
+
+        if 'channels' in metadata and not set(metadata['channels']) & {longname, shortname, name}:
+            continue
+
+        attrs['units'] = units
+        channels.append((column, name, attrs))
+
+    return channels
+
+def read_burstdata(conn, columns, chunksize=None, tstamps=None, order=False):
+    """
+    Read tstamp and the given channel columns from the burstdata table into
+    preallocated arrays in a single query, fetching chunksize rows at a time
+    so the full list of row tuples is never built. If tstamps is a (start,
+    stop) pair only rows in that range are read. If order is True the rows
+    are returned sorted by tstamp, which is only cheap when tstamp is indexed.
+    """
+
+    if chunksize is None:
+        chunksize = CHUNKSIZE
+
+    if tstamps is not None:
+        where = " WHERE tstamp >= %d AND tstamp < %d" % tstamps
+    else:
+        where = ""
+
+    nrows = conn.execute("SELECT COUNT(*) FROM burstdata" + where).fetchone()[0]
+
+    a = {}
+    a['unixtime'] = np.empty(nrows, dtype=np.int64)
+    for c in columns:
+        a[c] = np.empty(nrows, dtype=np.float64)
+
+    query = "SELECT tstamp, " + ", ".join(columns) + " FROM burstdata" + where
+    if order:
+        query += " ORDER BY tstamp"
+    conn.execute(query)
+
+    n = fetch_rows(conn, columns, a, 0, nrows, chunksize)
+
+    if n < nrows:
+        warnings.warn('expected %d rows from burstdata but only read %d' % (nrows, n))
+        for k in a:
+            a[k] = a[k][:n]
+
+    return a
+
+def fetch_rows(conn, columns, a, offset, nrows, chunksize):
+    """
+    Fetch up to nrows rows of tstamp and columns from the query just run on
+    the cursor conn, chunksize rows at a time, into the arrays in a starting
+    at offset. Returns the number of rows fetched.
+    """
+
+    n = 0
+    while n < nrows:
+        rows = conn.fetchmany(chunksize)
+        if not rows:
+            break
+        # don't overrun the arrays if rows were added since the count
+        m = min(len(rows), nrows - n)
+        cols = list(zip(*rows[:m]))
+        a['unixtime'][offset+n:offset+n+m] = cols[0]
+        for c, col in zip(columns, cols[1:]):
+            a[c][offset+n:offset+n+m] = col
+        n += m
+
+    return n
+
+def partition_burstdata(conn, nparts, tstamps=None, indexed=False, schedule=None):
+    """
+    Split burstdata into up to nparts independently readable ranges of
+    tstamp (if indexed) or rowid, as a list of WHERE clauses
+    """
+
+    if tstamps is not None:
+        where = "tstamp >= %d AND tstamp < %d" % tstamps
+    else:
+        where = None
+
+    if indexed:
+        t0, t1 = conn.execute("SELECT MIN(tstamp), MAX(tstamp) FROM burstdata").fetchone()
+        if t0 is None:
+            return [" WHERE " + where] if where else [""]
+        lo, hi = tstamps if tstamps is not None else (t0, t1 + 1)
+        if schedule is not None:
+            samplingcount, samplingperiod, repetitionperiod = schedule
+            guard = max(repetitionperiod - samplingcount * samplingperiod, samplingperiod) / 2
+            first = np.floor((max(lo, t0) - t0 + guard) / repetitionperiod)
+            last = np.ceil((min(hi, t1 + 1) - t0 + guard) / repetitionperiod)
+            bursts = np.round(np.linspace(first, last, nparts + 1))
+            edges = np.floor(t0 + bursts * repetitionperiod - guard).astype(np.int64)
+        else:
+            edges = np.round(np.linspace(max(lo, t0), min(hi, t1 + 1), nparts + 1)).astype(np.int64)
+        edges = np.clip(edges, lo, hi)
+        edges[0] = lo
+        edges[-1] = hi
+        edges = np.unique(edges)
+        if len(edges) < 2:
+            return [" WHERE " + where] if where else [""]
+        return [" WHERE tstamp >= %d AND tstamp < %d" % (edges[n], edges[n + 1])
+                for n in range(len(edges) - 1)]
+
+    try:
+        r0, r1 = conn.execute("SELECT MIN(rowid), MAX(rowid) FROM burstdata").fetchone()
+    except sqlite3.OperationalError: # a WITHOUT ROWID table
+        r0 = None
+    if r0 is None:
+        return [" WHERE " + where] if where else [""]
+
+    edges = np.unique(np.round(np.linspace(r0, r1 + 1, nparts + 1)).astype(np.int64))
+    return [" WHERE rowid >= %d AND rowid < %d" % (edges[n], edges[n + 1]) +
+            (" AND " + where if where else "") for n in range(len(edges) - 1)]
+
+def count_partition(rskfile, where, immutable=False):
+    """Number of rows of burstdata in a partition from partition_burstdata"""
+
+    conn = init_connection(rskfile, readonly=True, immutable=immutable)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM burstdata" + where).fetchone()[0]
+    finally:
+        conn.connection.close()
+
+def read_partition(rskfile, columns, where, a, offset, nrows, chunksize=None, order=False,
+                   immutable=False):
+    """
+    Read a partition from partition_burstdata on its own read-only
+    connection, directly into rows offset to offset + nrows of the arrays
+    in a. Returns the number of rows read.
+    """
+
+    if chunksize is None:
+        chunksize = CHUNKSIZE
+
+    conn = init_connection(rskfile, readonly=True, immutable=immutable)
+    try:
+        query = "SELECT tstamp, " + ", ".join(columns) + " FROM burstdata" + where
+        if order:
+            query += " ORDER BY tstamp"
+        conn.execute(query)
+        return fetch_rows(conn, columns, a, offset, nrows, chunksize)
+    finally:
+        conn.connection.close()
+
+def read_mapped_partition(rskfile, columns, where, arrays, offset, nrows, chunksize=None,
+                          order=False, immutable=False):
+    """
+    read_partition in a worker process, into the .npy files named in arrays,
+    which are memory mapped so every worker writes to the same arrays
+    """
+
+    a = dict((k, np.load(arrays[k], mmap_mode='r+')) for k in arrays)
+    n = read_partition(rskfile, columns, where, a, offset, nrows, chunksize, order, immutable)
+    for k in a:
+        a[k].flush()
+
+    return n
+
+def read_burstdata_parallel(rskfile, columns, workers, chunksize=None, tstamps=None, order=False,
+                            schedule=None, processes=False, immutable=False):
+    """
+    read_burstdata using workers concurrent connections, each reading one
+    partition from partition_burstdata, in threads or processes
+    """
+
+    conn = init_connection(rskfile, readonly=True, immutable=immutable)
+    try:
+        # the rowid range is a cheap upper bound on the number of rows
+        try:
+            rows = conn.execute("SELECT MAX(rowid) - MIN(rowid) + 1 FROM burstdata").fetchone()[0] or 0
+        except sqlite3.OperationalError:
+            rows = 0
+        nparts = max(min(workers, rows // PARTITION_ROWS), 1)
+        parts = partition_burstdata(conn, nparts, tstamps, order, schedule)
+    finally:
+        conn.connection.close()
+
+    Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with Executor(max_workers=min(workers, len(parts))) as pool:
+        counts = list(pool.map(count_partition, [rskfile] * len(parts), parts,
+                               [immutable] * len(parts)))
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        total = int(offsets[-1])
+
+        dtypes = dict([('unixtime', np.int64)] + [(c, np.float64) for c in columns])
+        tmp = None
+        out = {}
+        try:
+            if processes:
+                tmp = tempfile.mkdtemp(prefix='rsklib')
+                arrays = {}
+                for k in dtypes:
+                    arrays[k] = os.path.join(tmp, k + '.npy')
+                    out[k] = np.lib.format.open_memmap(arrays[k], mode='w+', dtype=dtypes[k],
+                                                       shape=(total,))
+                futures = [pool.submit(read_mapped_partition, rskfile, columns, parts[n], arrays,
+                                       offsets[n], counts[n], chunksize, order, immutable)
+                           for n in range(len(parts))]
+            else:
+                for k in dtypes:
+                    out[k] = np.empty(total, dtype=dtypes[k])
+                futures = [pool.submit(read_partition, rskfile, columns, parts[n], out,
+                                       offsets[n], counts[n], chunksize, order, immutable)
+                           for n in range(len(parts))]
+            nread = [f.result() for f in futures]
+
+            # copy out of the memory maps, closing up any gaps left by rows
+            # that went missing since they were counted
+            if processes or sum(nread) < total:
+                if sum(nread) < total:
+                    warnings.warn('expected %d rows from burstdata but only read %d' % (total, sum(nread)))
+                a = dict((k, np.concatenate([out[k][offsets[n]:offsets[n] + nread[n]]
+                                             for n in range(len(parts))])) for k in out)
+            else:
+                a = out
+        finally:
+            out = None
+            if tmp is not None:
+                shutil.rmtree(tmp, ignore_errors=True)
+
+    return a
+
+def sort_burstdata(a):
+    """
+    Sort the arrays in a by a['unixtime'] in place, touching only the part
+    of the record that is out of order. Returns a description of what was
+    done.
+    """
+
+    t = a['unixtime']
+    breaks = np.flatnonzero(t[1:] < t[:-1])
+    if len(breaks) == 0:
+        return 'already sorted'
+
+    # smallest window that contains every out-of-order sample; the data
+    # either side of it are sorted and already in their final position
+    lo = breaks[0]
+    hi = breaks[-1] + 2
+    lo = np.searchsorted(t[:lo], t[lo:hi].min(), side='right')
+    hi += np.searchsorted(t[hi:], t[lo:hi].max(), side='left')
+
+    # the stable sort is a timsort, so it merges the sorted runs within the
+    # window rather than sorting from scratch
+    sort = np.argsort(t[lo:hi], kind='stable')
+    for k in a:
+        a[k][lo:hi] = a[k][lo:hi][sort]
+
+    return 'sorted %d of %d samples in %d runs' % (hi - lo, len(t), len(breaks) + 1)
+
+def segment_bursts(a, samplingcount, samplingperiod, repetitionperiod, origin=None):
+    """
+    Split the sorted samples in a into bursts of samplingcount samples on
+    the grid of the sampling schedule (periods in ms), allowing for drift.
+    The grid is estimated from the samples, or if origin is given it is the
+    start tstamp of an earlier burst, which a read of a single burst needs.
+    Returns a dict with the burst start times in 'unixtime', every other
+    array shaped (burst, sample) with NaN where samples are missing, and the
+    fraction of samples present in each burst in 'completeness'.
+    """
 
-    print('Loading from sqlite file %s; this may take a while for large datasets' % rskfile)
+    t = a['unixtime']
+    n = len(t)
+    b = {}
+
+    if n == 0:
+        for k in a:
+            b[k] = np.empty((0, samplingcount))
+        b['unixtime'] = np.empty(0, dtype=np.int64)
+        b['completeness'] = np.empty(0)
+        return b
+
+    # fast path: if every row of the reshaped record spans exactly one burst
+    # no samples were dropped and the reshape is all we need
+    if n and n % samplingcount == 0:
+        t2 = t.reshape((-1, samplingcount))
+        duration = t2[:, -1] - t2[:, 0]
+        if np.all(np.abs(duration - (samplingcount - 1) * samplingperiod) < samplingperiod / 2):
+            for k in a:
+                b[k] = a[k].reshape((-1, samplingcount))
+            b['unixtime'] = b['unixtime'][:, 0]
+            b['completeness'] = np.ones(len(t2))
+            return b
+
+    # burst boundaries go halfway through the gap between the last sample
+    # of one burst and the first of the next, so neither a dropout nor a
+    # short idle time between bursts splits a burst
+    idle = repetitionperiod - samplingcount * samplingperiod
+    guard = (max(idle, 0) + samplingperiod) / 2
+    anchored = origin is not None
+    head = t[:np.searchsorted(t, t[0] + DRIFT_BURSTS * repetitionperiod)]
+    if not anchored:
+        origin = t[0]
+    if not anchored and idle > samplingperiod and head[-1] - head[0] >= repetitionperiod:
+        # bursts start at the end of the longest stretch of the repetition
+        # period with no samples, even if the record starts with a dropout.
+        # Within a single burst that is just its first sample
+        nbins = int(np.ceil(repetitionperiod / samplingperiod))
+        phase = ((head - t[0]) % repetitionperiod // samplingperiod).astype(np.int64)
+        empty = np.bincount(phase, minlength=nbins)[:nbins] == 0
+        if empty.any():
+            shift = np.flatnonzero(~empty)[0]
+            edges = np.diff(np.concatenate(([0], np.roll(empty, -shift), [0])).astype(int))
+            runstart = np.flatnonzero(edges == 1)
+            runstop = np.flatnonzero(edges == -1)
+            startbin = (runstop[np.argmax(runstop - runstart)] + shift) % nbins
+            origin = t[0] + startbin * samplingperiod
+
+    # t is sorted, so each burst is a run of equal grid numbers
+    grid = np.floor((t - origin + guard) / repetitionperiod).astype(np.int64)
+    first = np.concatenate(([0], np.flatnonzero(np.diff(grid)) + 1))
+    grid = grid[first]
+    gridtime = origin + grid * repetitionperiod
+
+    # follow slow clock drift using the first sample time of each burst
+    # relative to the grid. Where the first samples of a burst were
+    # dropped, the whole sampling periods by which it differs from the
+    # running median of its neighbours are taken off
+    drift = t[first] - gridtime
+    if anchored:
+        # the burst at origin is on time, so it counts towards the median
+        drift = np.concatenate(([0], drift))
+    half = min(DRIFT_BURSTS, len(drift)) // 2
+    median = np.median(np.lib.stride_tricks.sliding_window_view(
+        np.pad(drift, half, mode='reflect'), 2 * half + 1), axis=1)
+    drift = drift - np.round((drift - median) / samplingperiod) * samplingperiod
+    if anchored:
+        drift = drift[1:]
+
+    if np.all(np.abs(drift) < guard / 2):
+        # too little drift to move any sample across a burst boundary
+        starts = gridtime + drift
+    else:
+        grid = np.floor((t - origin - np.interp(t, gridtime, drift) + guard) /
+                        repetitionperiod).astype(np.int64)
+        first = np.concatenate(([0], np.flatnonzero(np.diff(grid)) + 1))
+        starts = origin + grid[first] * repetitionperiod
+        starts = starts + np.interp(starts, gridtime, drift)
+    burst = np.repeat(np.arange(len(first)), np.diff(np.concatenate((first, [n]))))
+
+    sample = np.round((t - starts[burst]) / samplingperiod).astype(np.int64)
+    good = (sample >= 0) & (sample < samplingcount)
+    if np.all(good):
+        good = slice(None)
+    else:
+        warnings.warn('%d samples did not fit the sampling schedule and were '
+                      'discarded' % np.sum(~good))
+        burst = burst[good]
+        sample = sample[good]
+
+    nbursts = len(starts)
+    for k in a:
+        if k == 'unixtime':
+            continue
+        b[k] = np.full((nbursts, samplingcount), np.nan)
+        b[k][burst, sample] = a[k][good]
+
+    b['unixtime'] = np.round(starts).astype(np.int64)
+    filled = np.zeros((nbursts, samplingcount), dtype=bool)
+    filled[burst, sample] = True
+    b['completeness'] = filled.sum(axis=1) / samplingcount
+
+    return b
+
+def hold_incomplete_burst(b, t, finished=None):
+    """
+    Remove a final incomplete burst, which may still be being recorded, from
+    the bursts b returned by segment_bursts for the sorted tstamps t. If
+    finished is given, an incomplete final burst that started before that
+    tstamp is kept, since no more samples will arrive for it. Returns b and
+    the number of samples in t that belong to the bursts kept.
+    """
+
+    if not len(b['completeness']) or b['completeness'][-1] == 1:
+        return b, len(t)
+
+    if finished is not None and b['unixtime'][-1] < finished:
+        return b, len(t)
+
+    last = np.searchsorted(t, b['unixtime'][-1])
+    for k in b:
+        b[k] = b[k][:-1]
+
+    return b, last
+
+def read_rsk(metadata, chunksize=None, clip=True, since=None, workers=None, processes=False):
+    """
+    Read the burst data (only that after tstamp since, if given) from the
+    RSK file and add its schedule and instrument information to metadata
+    """
+
+    rskfile = metadata['basefile'] + '.rsk'
 
     conn = init_connection(rskfile)
 
-    conn.execute("SELECT tstamp, channel01 FROM burstdata")
-    data = conn.fetchall()
-    print("Done fetching data")
-    d = np.asarray(data)
     # Get samples per burst
     samplingcount = conn.execute("select samplingcount from schedules").fetchall()[0][0]
 
@@ -57,37 +637,302 @@ def rsk_to_xr(metadata):
     metadata['burst_interval'] = repetitionperiod / 1000
     metadata['burst_length'] = metadata['samples_per_burst'] * metadata['sample_interval']
     metadata['serial_number'] = conn.execute("select serialID from instruments").fetchall()[0][0]
-    metadata['INST_TYPE'] = 'RBR Virtuoso d|wave'
 
-    a = {}
-    a['unixtime'] = d[:,0].copy()
-    a['pres'] = d[:,1].copy()
+    channels = read_channels(conn, metadata)
+    if not channels:
+        raise ValueError('no channels selected from %s' % rskfile)
+    print('Reading channels: %s' % ', '.join(c[1] for c in channels))
+
+    if 'INST_TYPE' not in metadata:
+        if all(c[1].startswith('P_1') for c in channels):
+            metadata['INST_TYPE'] = 'RBR Virtuoso d|wave'
+        else:
+            model = conn.execute("select model from instruments").fetchall()[0][0]
+            metadata['INST_TYPE'] = model
+
+    indexed = has_tstamp_index(conn)
+
+    tstamps = None
+    if clip:
+        tstamps = clip_tstamps(conn, metadata)
+        if tstamps is not None:
+            if not indexed:
+                print('No index on tstamp; clipping requires a full table scan')
+            # cdf_to_nc checks for this so the data are not clipped twice
+            if 'good_ens' in metadata:
+                metadata['rsk_clipped'] = 'good_ens'
+            else:
+                metadata['rsk_clipped'] = 'Deployment_date, Recovery_date'
+            metadata['rsk_clip_settings'] = clip_settings(metadata)
+
+    if since is not None:
+        if tstamps is None:
+            tstamps = (since + 1, np.iinfo(np.int64).max)
+        else:
+            tstamps = (max(tstamps[0], since + 1), tstamps[1])
+
+    # with an index SQLite can return rows in tstamp order for free
+    with profiling.stage('fetch', file=rskfile, workers=workers) as record:
+        if workers is not None and workers > 1:
+            # a file still being recorded (since is given) must be locked
+            a = read_burstdata_parallel(rskfile, [c[0] for c in channels], workers, chunksize,
+                                        tstamps, order=indexed,
+                                        schedule=(samplingcount, samplingperiod, repetitionperiod),
+                                        processes=processes, immutable=since is None)
+        else:
+            a = read_burstdata(conn, [c[0] for c in channels], chunksize, tstamps, order=indexed)
+        record.update(rows=len(a['unixtime']), bytes=sum(a[k].nbytes for k in a))
+
     # sort by time (not sorted for some reason)
-    sort = np.argsort(a['unixtime'])
-    a['unixtime'] = a['unixtime'][sort]
-    a['pres'] = a['pres'][sort]
+    with profiling.stage('sort') as record:
+        if indexed:
+            metadata['rsk_sort'] = 'ORDER BY tstamp'
+        else:
+            metadata['rsk_sort'] = sort_burstdata(a)
+        record['result'] = metadata['rsk_sort']
+
+    t = a['unixtime']
+
+    # split into bursts, leaving gaps where samples were dropped
+    with profiling.stage('reshape', rows=len(t)) as record:
+        # when appending there may be just one burst to go on, so put it on
+        # the grid of the last burst read before
+        origin = metadata.get('rsk_last_burst') if since is not None else None
+        a = segment_bursts(a, samplingcount, samplingperiod, repetitionperiod, origin)
+        record['bursts'] = len(a['unixtime'])
+
+    if since is not None:
+        a, last = hold_incomplete_burst(a, t)
+        kept = a['unixtime']
+        if last < len(t):
+            print('Leaving incomplete final burst for the next update')
+    else:
+        # a final incomplete burst is kept, but read again by the next append
+        held, last = hold_incomplete_burst(dict(a), t)
+        kept = held['unixtime']
+
+    if len(kept):
+        metadata['rsk_last_burst'] = int(kept[-1])
+
+    # rsk_to_cdf(append=True) reads on from here next time
+    if last:
+        metadata['rsk_last_tstamp'] = int(t[last - 1])
+    elif since is not None:
+        metadata['rsk_last_tstamp'] = since
+    elif len(t):
+        metadata['rsk_last_tstamp'] = int(t[0]) - 1
+
+    incomplete = np.sum(a['completeness'] < 1)
+    if incomplete:
+        print('%d of %d bursts are missing samples' % (incomplete, len(a['completeness'])))
+
+    return a, channels
+
+def cache_key(rskfile, metadata, clip):
+    """
+    Key for the cached arrays of an RSK file, from its path, size and
+    modification time and the metadata that affect what is read
+    """
+
+    stat = os.stat(rskfile)
+    params = [CACHE_VERSION, os.path.abspath(rskfile), stat.st_size, stat.st_mtime, clip]
+    for k in ['good_ens', 'Deployment_date', 'Recovery_date', 'channels']:
+        params.append((k, metadata.get(k)))
+
+    return hashlib.sha1(repr(params).encode('utf-8')).hexdigest()
+
+def load_cache(cachedir, key):
+    """
+    Load cached arrays as read-only memory maps, along with the information
+    saved with them. Returns None if there is no cache entry for key.
+    """
+
+    entry = os.path.join(cachedir, key)
+    try:
+        with open(os.path.join(entry, 'info.json')) as f:
+            info = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    a = {}
+    for k in info['arrays']:
+        a[k] = np.load(os.path.join(entry, k + '.npy'), mmap_mode='r')
+
+    # mark as recently used so it is evicted last
+    os.utime(entry, None)
+
+    return a, info
+
+def save_cache(cachedir, key, a, info, maxsize=None):
+    """
+    Save arrays and information about them to the cache, then evict the
+    least recently used entries until the cache is no larger than maxsize
+    bytes
+    """
 
-    # get indices that end at the end of the final burst
-    datlength = a['unixtime'].shape[0] - a['unixtime'].shape[0] % samplingcount
+    entry = os.path.join(cachedir, key)
+    tmp = entry + '.tmp%d' % os.getpid()
+    os.makedirs(tmp)
 
-    # reshape
     for k in a:
-        a[k] = a[k][:datlength].reshape((int(datlength/samplingcount), samplingcount))
+        np.save(os.path.join(tmp, k + '.npy'), a[k])
+    info['arrays'] = list(a)
+    with open(os.path.join(tmp, 'info.json'), 'w') as f:
+        json.dump(info, f)
+
+    # move into place in one step so readers never see a partial entry
+    if os.path.exists(entry):
+        shutil.rmtree(entry)
+    os.rename(tmp, entry)
+
+    evict_cache(cachedir, maxsize)
+
+def evict_cache(cachedir, maxsize=None):
+    """Remove the least recently used cache entries beyond maxsize bytes"""
+
+    if maxsize is None:
+        maxsize = CACHE_SIZE
+
+    entries = []
+    for key in os.listdir(cachedir):
+        entry = os.path.join(cachedir, key)
+        if not os.path.isdir(entry):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        entries.append((os.path.getmtime(entry), size, entry))
+
+    # newest first; always keep the most recent entry
+    entries.sort(reverse=True)
+    total = 0
+    for n, (mtime, size, entry) in enumerate(entries):
+        total += size
+        if n and total > maxsize:
+            shutil.rmtree(entry, ignore_errors=True)
+
+def clear_cache(cachedir):
+    """Remove all cached RSK arrays"""
+
+    for key in os.listdir(cachedir):
+        shutil.rmtree(os.path.join(cachedir, key), ignore_errors=True)
+
+def cached_read_rsk(metadata, cachedir, chunksize=None, clip=True, workers=None, processes=False):
+    """
+    read_rsk, but reusing the arrays saved in cachedir by an earlier read of
+    the same RSK file with the same parameters
+    """
+
+    rskfile = metadata['basefile'] + '.rsk'
+    key = cache_key(rskfile, metadata, clip)
+
+    cached = load_cache(cachedir, key)
+    if cached is not None:
+        print('Loading %s from cache in %s' % (rskfile, cachedir))
+        a, info = cached
+        for k in info['metadata']:
+            # INST_TYPE from the config takes precedence, as in read_rsk
+            if k == 'INST_TYPE' and k in metadata:
+                continue
+            metadata[k] = info['metadata'][k]
+        return a, [tuple(c) for c in info['channels']]
+
+    a, channels = read_rsk(metadata, chunksize, clip, workers=workers, processes=processes)
+
+    info = {'metadata': dict((k, metadata[k]) for k in CACHE_METADATA if k in metadata),
+            'channels': channels}
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    save_cache(cachedir, key, a, info)
+
+    return a, channels
+
+def diagnostic_variables(ds):
+    """Names of the per-burst diagnostic variables rsk_to_xr added to ds"""
 
-    times = pd.to_datetime(a['unixtime'][:,0], unit='ms')
+    names = [k + '_' + s for k in ds.data_vars if 'sample' in ds[k].dims for s in DIAGNOSTICS]
+    names.append('burst_completeness')
+
+    return [k for k in names if k in ds]
+
+def burst_diagnostics(x):
+    """
+    Compute the mean, standard deviation, number of spikes (see
+    SPIKE_THRESHOLD) and longest run of identical samples (a sign of a stuck
+    sensor) of each burst in the (burst, sample) array x, ignoring missing
+    samples. Returns a dict of (burst,) arrays.
+    """
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(x, axis=1)
+        std = np.nanstd(x, axis=1)
+        median = np.nanmedian(x, axis=1)[:, None]
+        mad = np.nanmedian(np.abs(x - median), axis=1)[:, None]
+
+    with np.errstate(invalid='ignore'):
+        spikes = np.sum(np.abs(x - median) > SPIKE_THRESHOLD * 1.4826 * mad, axis=1)
+
+    # length of the run of equal differences ending at each sample, by
+    # subtracting the running count at the last unequal difference
+    same = (np.diff(x, axis=1) == 0).astype(np.int64)
+    count = np.cumsum(same, axis=1)
+    runs = count - np.maximum.accumulate(np.where(same == 0, count, 0), axis=1)
+    flatline = (runs.max(axis=1) if runs.shape[1] else np.zeros(len(x), np.int64)) + 1
+
+    return {'mean': mean, 'std': std, 'spikes': spikes, 'flatline': flatline}
+
+def rsk_to_xr(metadata, chunksize=None, clip=True, cache=None, since=None, workers=None,
+              processes=False):
+    """
+    Load data from RSK file and generate an xarray Dataset. See read_rsk for
+    clip, since, workers and processes. If cache is a directory, the arrays read from the RSK
+    file are cached there and memory mapped on later calls with the same
+    file and parameters.
+    """
+
+    if cache is not None and since is None:
+        a, channels = cached_read_rsk(metadata, cache, chunksize, clip, workers, processes)
+    else:
+        a, channels = read_rsk(metadata, chunksize, clip, since, workers, processes)
+
+    samplingcount = metadata['samples_per_burst']
+
+    times = pd.to_datetime(a['unixtime'], unit='ms')
     samples = np.arange(samplingcount)
 
     dwave = {}
 
-    dwave['P_1'] = xr.DataArray(a['pres'], coords=[times, samples],
-        dims=('time', 'sample'), name='Pressure',
-        attrs={'long_name': 'Pressure',
-               '_FillValue': 1e35,
-               'units': 'dbar',
-               'epic_code': 1,
-               'height_depth_units': 'm',
-               'initial_instrument_height': metadata['initial_instrument_height'],
-               'serial_number': metadata['serial_number']})
+    for column, name, attrs in channels:
+        attrs = dict(attrs)
+        attrs.update({'_FillValue': 1e35,
+                      'height_depth_units': 'm',
+                      'initial_instrument_height': metadata['initial_instrument_height'],
+                      'serial_number': metadata['serial_number']})
+        dwave[name] = xr.DataArray(a[column], coords=[times, samples],
+            dims=('time', 'sample'), name=name, attrs=attrs)
+
+        # per-burst diagnostics, in blocks of bursts to bound the temporaries
+        block = max(CHUNKSIZE // samplingcount, 1)
+        diag = [burst_diagnostics(a[column][i:i + block]) for i in range(0, len(times), block)]
+        diag = {k: np.concatenate([d[k] for d in diag]) if diag else np.empty(0)
+                for k in DIAGNOSTICS}
+
+        dwave[name + '_mean'] = xr.DataArray(diag['mean'], coords=[times], dims=('time'),
+            attrs={'long_name': 'Burst mean of ' + name, 'units': attrs['units']})
+        dwave[name + '_std'] = xr.DataArray(diag['std'], coords=[times], dims=('time'),
+            attrs={'long_name': 'Burst standard deviation of ' + name, 'units': attrs['units']})
+        dwave[name + '_spikes'] = xr.DataArray(diag['spikes'].astype('int32'), coords=[times], dims=('time'),
+            attrs={'long_name': 'Number of spikes in burst of ' + name,
+                   'units': '1',
+                   'note': 'Samples more than %g times 1.4826 median absolute deviations '
+                           'from the burst median' % SPIKE_THRESHOLD})
+        dwave[name + '_flatline'] = xr.DataArray(diag['flatline'].astype('int32'), coords=[times], dims=('time'),
+            attrs={'long_name': 'Longest run of identical samples in burst of ' + name,
+                   'units': '1'})
+
+    dwave['burst_completeness'] = xr.DataArray(a['completeness'], coords=[times],
+        dims=('time'), name='burst_completeness',
+        attrs={'long_name': 'Fraction of samples present in burst',
+               'units': '1'})
 
     dwave['time'] = xr.DataArray(times, dims=('time'), name='time')
 
@@ -120,24 +965,41 @@ def rsk_to_xr(metadata):
 
     return RAW, metadata
 
-def xr_to_cdf(RAW, metadata):
-    """Write raw xarray Dataset to .cdf"""
+def xr_to_cdf(RAW, metadata, encoding=None, zarr=None):
+    """
+    Write raw xarray Dataset to .cdf, using the named profile in
+    ncio.ENCODINGS if encoding is given. If zarr is 'dir' or 'zip', write a
+    Zarr store instead (see ncio.write_zarr).
+    """
 
     cdf_filename = metadata['filename'] + '-raw.cdf'
 
-    RAW.to_netcdf(cdf_filename)
+    if zarr:
+        ncio.write_zarr(RAW, cdf_filename, encoding=encoding, zarr=zarr)
+        return
+
+    RAW, encoding = ncio.netcdf_encoding(RAW, encoding)
+
+    with profiling.stage('write', file=cdf_filename, bytes=RAW.nbytes) as record:
+        # time is unlimited so later bursts can be appended
+        RAW.to_netcdf(cdf_filename, unlimited_dims=['time'], encoding=encoding)
+        record['file_bytes'] = ncio.file_size(cdf_filename)
 
 def write_metadata(ds, metadata):
     """Write metadata to Dataset"""
 
     for k in metadata:
-        ds.attrs.update({k: metadata[k]})
+        # netCDF attributes can't hold nested values such as qc_rules, or
+        # lists with nulls such as wave_frequency_band
+        if isinstance(metadata[k], dict) or (isinstance(metadata[k], list) and
+                                             any(v is None or isinstance(v, (dict, list))
+                                                 for v in metadata[k])):
+            ds.attrs.update({k: json.dumps(metadata[k])})
+        else:
+            ds.attrs.update({k: metadata[k]})
 
-    f = os.path.basename(inspect.stack()[1][1])
-
-    ds.attrs.update({'history': 'Processed using ' + f + ' with Python ' +
-        platform.python_version() + ', xarray ' + xr.__version__ + ', NumPy ' +
-        np.__version__ + ', netCDF4 ' + netCDF4.__version__})
+    # the script that called us, without inspect.stack() reading every source file
+    ds.attrs.update({'history': profiling.history(sys._getframe(1).f_code.co_filename)})
 
     return ds
 
@@ -157,20 +1019,36 @@ def write_metadata(ds, metadata):
         # Pressid.height_depth_units = 'm'
 
 def main():
-    import sys
-    sys.path.insert(0, '/Users/dnowacki/Documents/rsklib')
-    import rsklib
     import argparse
     import yaml
 
     parser = argparse.ArgumentParser(description='Convert raw RBR d|wave files (.rsk) to raw .cdf format. Run this script from the directory containing d|wave files')
     parser.add_argument('gatts', help='path to global attributes file (gatts formatted)')
     parser.add_argument('config', help='path to ancillary config file (YAML formatted)')
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE,
+                        help='number of rows to read from the RSK file at a time (default %d)' % CHUNKSIZE)
+    parser.add_argument('--no-clip', dest='clip', action='store_false',
+                        help='read the whole RSK file instead of clipping to the deployment in the config')
+    parser.add_argument('--cache', help='directory in which to cache the arrays read from the RSK file')
+    parser.add_argument('--append', action='store_true',
+                        help='only read bursts recorded since the raw .cdf file was last written and append them to it')
+    parser.add_argument('--encoding', choices=sorted(ncio.ENCODINGS),
+                        help='compression and pressure dtype profile for the .cdf file (default: uncompressed float64)')
+    parser.add_argument('--zarr', choices=['dir', 'zip'],
+                        help='write a Zarr store (directory or zip file) instead of the .cdf file (requires zarr and dask)')
+    parser.add_argument('--workers', type=int,
+                        help='read the RSK file in this many partitions at once')
+    parser.add_argument('--processes', action='store_true',
+                        help='use worker processes rather than threads for --workers, which scales better')
+    parser.add_argument('--metrics', help='file to append the time, throughput and peak memory of each stage to as JSON lines')
+    parser.add_argument('--profile', help='directory in which to write cProfile stats for each stage')
 
     args = parser.parse_args()
 
+    profiling.configure(metrics=args.metrics, profile=args.profile)
+
     # initialize metadata from the globalatts file
-    metadata = rsklib.read_globalatts(args.gatts)
+    metadata = globalatts.read_globalatts(args.gatts)
 
     # Add additional metadata from metadata config file
     config = yaml.safe_load(open(args.config))
@@ -178,7 +1056,9 @@ def main():
     for k in config:
         metadata[k] = config[k]
 
-    ds = rsklib.rsk_to_cdf(metadata)
+    ds = rsk_to_cdf(metadata, chunksize=args.chunksize, clip=args.clip, cache=args.cache,
+                    append=args.append, encoding=args.encoding, zarr=args.zarr,
+                    workers=args.workers, processes=args.processes)
 
     return ds
 
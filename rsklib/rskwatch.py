@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+from __future__ import division, print_function
+
+import os
+import csv
+import time
+import threading
+import argparse
+import numpy as np
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from . import lazy_import, globalatts, waves, rskrsk2cdf, rskcdf2nc
+# pandas and xarray are only imported when first used
+pd = lazy_import('pandas')
+xr = lazy_import('xarray')
+
+# columns of the wave statistics output file
+COLUMNS = ['time', 'tstamp', 'wh_4061', 'wp_peak', 'wp_4060', 'latency']
+
+
+def read_bursts(rskfile, since, bursts, stop, interval, origin=None):
+    """
+    Poll a live RSK file every interval seconds for complete bursts of
+    pressure recorded after tstamp since, on the grid of the burst starting
+    at tstamp origin if given (see segment_bursts), putting (burst start
+    tstamps, (burst, sample) pressure) on the bursts queue. Meant to run in
+    a background thread so reading overlaps processing. Puts None on the
+    queue when stopped, or the exception if reading fails.
+    """
+
+    try:
+        conn = rskrsk2cdf.init_connection(rskfile, readonly=True)
+
+        samplingcount, samplingperiod, repetitionperiod = conn.execute(
+            "select samplingcount, samplingperiod, repetitionperiod from schedules").fetchall()[0]
+        channels = rskrsk2cdf.read_channels(conn, {'channels': ['Pressure']})
+        column = channels[0][0]
+        indexed = rskrsk2cdf.has_tstamp_index(conn)
+
+        while not stop.is_set():
+            a = rskrsk2cdf.read_burstdata(conn, [column], tstamps=(since + 1, np.iinfo(np.int64).max),
+                                          order=indexed)
+            if len(a['unixtime']):
+                if not indexed:
+                    rskrsk2cdf.sort_burstdata(a)
+                t = a['unixtime']
+                b = rskrsk2cdf.segment_bursts(a, samplingcount, samplingperiod, repetitionperiod,
+                                              origin)
+                # an incomplete burst is finished once it is a poll past its scheduled end
+                finished = time.time() * 1000 - samplingcount * samplingperiod - interval * 1000
+                b, last = rskrsk2cdf.hold_incomplete_burst(b, t, finished)
+                if last:
+                    since = int(t[last - 1])
+                if len(b['unixtime']):
+                    # a poll usually finds a single burst, so keep to the grid
+                    origin = int(b['unixtime'][-1])
+                    bursts.put((b['unixtime'], b[column]))
+            stop.wait(interval)
+    except Exception as e:
+        bursts.put(e)
+        return
+
+    bursts.put(None)
+
+
+def burst_waves(starts, pres, metadata, atmpres=None):
+    """
+    Atmospherically correct the (burst, sample) pressure using the met
+    Dataset atmpres and compute wave statistics for each burst. Returns
+    wh_4061, wp_peak and wp_4060.
+    """
+
+    if atmpres is not None:
+        ds = xr.Dataset({'P_1': (('time', 'sample'), pres)},
+                        coords={'time': pd.to_datetime(starts, unit='ms')})
+        ds = rskcdf2nc.atmospheric_correction(ds, atmpres,
+                                              max_gap=metadata.get('atmpres_max_gap'))
+        pres = ds['P_1ac'].values
+
+    fs = 1 / metadata['sample_interval']
+    height = metadata['initial_instrument_height']
+
+    frequency = waves.spectral_frequency(pres.shape[-1], fs)
+    pspec = waves.surface_spectra(pres, fs, height)
+
+    return waves.wave_statistics(frequency, pspec)
+
+
+def last_written(outfile):
+    """Return the start tstamp of the last burst in the output file, or None"""
+
+    if not os.path.exists(outfile):
+        return None
+
+    last = None
+    with open(outfile) as f:
+        for row in csv.DictReader(f):
+            last = int(row['tstamp'])
+
+    return last
+
+
+def watch_rsk(metadata, atmpres=None, outfile=None, interval=10, max_bursts=None):
+    """
+    Watch a live RSK file and, as each burst is completed, atmospherically
+    correct it, compute wave statistics and append them to a CSV file along
+    with the latency from the end of the burst to the statistics being
+    written. Resumes after the last burst in an existing output file. Runs
+    until interrupted, the Recovery_date in the metadata is reached, or
+    max_bursts bursts have been processed.
+    """
+
+    rskfile = metadata['basefile'] + '.rsk'
+    if outfile is None:
+        outfile = metadata['filename'] + 'waves.csv'
+
+    conn = rskrsk2cdf.init_connection(rskfile, readonly=True)
+    samplingcount, samplingperiod = conn.execute(
+        "select samplingcount, samplingperiod from schedules").fetchall()[0]
+    conn.connection.close()
+    metadata['sample_interval'] = samplingperiod / 1000
+    burst_length = samplingcount * samplingperiod
+
+    since = 0
+    if 'Deployment_date' in metadata:
+        since = pd.Timestamp(metadata['Deployment_date']).value // 10**6 - 1
+    recovery = None
+    if 'Recovery_date' in metadata:
+        recovery = pd.Timestamp(metadata['Recovery_date']).value // 10**6
+
+    last = last_written(outfile)
+    if last is not None:
+        print('Resuming after burst at %s' % pd.to_datetime(last, unit='ms'))
+        since = max(since, last + (samplingcount - 1) * samplingperiod)
+
+    if atmpres is not None:
+        # read the met record once rather than for every burst
+        atmpres = xr.open_dataset(atmpres, autoclose=True).load()
+        if not atmpres.indexes['time'].is_monotonic_increasing:
+            atmpres = atmpres.sortby('time')
+
+    bursts = queue.Queue()
+    stop = threading.Event()
+    reader = threading.Thread(target=read_bursts, args=(rskfile, since, bursts, stop, interval, last))
+    reader.daemon = True
+    reader.start()
+
+    print('Watching %s for new bursts' % rskfile)
+
+    latencies = []
+    newfile = not os.path.exists(outfile)
+    try:
+        with open(outfile, 'a') as f:
+            writer = csv.writer(f)
+            if newfile:
+                writer.writerow(COLUMNS)
+
+            while max_bursts is None or len(latencies) < max_bursts:
+                item = bursts.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                starts, pres = item
+                if recovery is not None:
+                    keep = starts <= recovery
+                    starts, pres = starts[keep], pres[keep]
+                    if not len(starts):
+                        print('Reached Recovery_date')
+                        break
+                if max_bursts is not None:
+                    # a poll can return several bursts; only process those still allowed
+                    n = max_bursts - len(latencies)
+                    starts, pres = starts[:n], pres[:n]
+
+                wh, wp_peak, wp_mean = burst_waves(starts, pres, metadata, atmpres)
+
+                # latency from the scheduled end of each burst
+                latency = time.time() - (starts + burst_length) / 1000
+                for n in range(len(starts)):
+                    writer.writerow([pd.to_datetime(starts[n], unit='ms').isoformat(), starts[n],
+                                     wh[n], wp_peak[n], wp_mean[n], '%.3f' % latency[n]])
+                    print('Burst at %s: wh_4061 %.2f m, wp_peak %.1f s, latency %.1f s'
+                          % (pd.to_datetime(starts[n], unit='ms'), wh[n], wp_peak[n], latency[n]))
+                f.flush()
+
+                latencies.extend(latency)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+
+    if latencies:
+        print('%d bursts; latency median %.1f s, max %.1f s'
+              % (len(latencies), np.median(latencies), np.max(latencies)))
+
+    return latencies
+
+
+def main():
+    import yaml
+
+    parser = argparse.ArgumentParser(description='Compute wave statistics from a live RBR d|wave file (.rsk) as each burst is recorded')
+    parser.add_argument('gatts', help='path to global attributes file (gatts formatted)')
+    parser.add_argument('config', help='path to ancillary config file (YAML formatted)')
+    parser.add_argument('--atmpres', help='path to cdf file containing atmopsheric pressure data')
+    parser.add_argument('--output', help='CSV file to append wave statistics to (default: <filename>waves.csv)')
+    parser.add_argument('--interval', type=float, default=10, help='seconds between polls of the RSK file (default 10)')
+
+    args = parser.parse_args()
+
+    # initialize metadata from the globalatts file
+    metadata = globalatts.read_globalatts(args.gatts)
+
+    # Add additional metadata from metadata config file
+    config = yaml.safe_load(open(args.config))
+
+    for k in config:
+        metadata[k] = config[k]
+
+    latencies = watch_rsk(metadata, atmpres=args.atmpres, outfile=args.output, interval=args.interval)
+
+    return latencies
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+from __future__ import division, print_function
+
+import warnings
+import numpy as np
+
+# gravitational acceleration (m/s^2)
+G = 9.81
+
+# frequency resolution (Hz) of the spectra, as used in scripts/rundiwasp.m
+DF = 1 / 128
+
+# Newton steps used by solve_dispersion
+NEWTON_STEPS = 3
+
+# depths (m) are rounded to this resolution when caching wavenumbers
+DEPTH_RESOLUTION = 0.01
+
+# maximum number of depths cached for each frequency grid
+WAVENUMBER_CACHE_SIZE = 100000
+_wavenumber_cache = {}
+
+# spectral bins where the pressure response factor is smaller than this are
+# not corrected, since the correction would mostly amplify noise
+MINIMUM_KP = 0.1
+
+# runs of up to this many dropped samples are linearly interpolated before
+# computing spectra; segments with longer gaps are left out of the average
+MAX_GAP_SAMPLES = 4
+
+
+def spectral_frequency(nsamples, fs, nfft=None):
+    """
+    Frequencies (excluding 0 Hz) of the spectra pressure_spectra computes
+    from bursts of nsamples samples
+    """
+
+    if nfft is None:
+        nfft = int(round(fs / DF))
+    nfft = min(nfft, nsamples)
+
+    return np.fft.rfftfreq(nfft, 1 / fs)[1:]
+
+
+def fill_gaps(pres, maxgap=MAX_GAP_SAMPLES):
+    """
+    Linearly interpolate runs of at most maxgap NaN samples within each
+    burst of the (burst, sample) array pres. Longer runs, and those at the
+    ends of a burst, are left as NaN.
+    """
+
+    missing = np.isnan(pres)
+    if not missing.any():
+        return pres
+
+    # the nearest valid sample before and after every sample
+    nsamples = pres.shape[-1]
+    idx = np.arange(nsamples)
+    before = np.maximum.accumulate(np.where(missing, -1, idx), axis=-1)
+    after = np.minimum.accumulate(np.where(missing, nsamples, idx)[..., ::-1], axis=-1)[..., ::-1]
+
+    fill = missing & (before >= 0) & (after < nsamples) & (after - before - 1 <= maxgap)
+    lo = np.take_along_axis(pres, np.clip(before, 0, nsamples - 1), axis=-1)
+    hi = np.take_along_axis(pres, np.clip(after, 0, nsamples - 1), axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = (idx - before) / (after - before)
+
+    return np.where(fill, lo + weight * (hi - lo), pres)
+
+
+def pressure_spectra(pres, fs, nfft=None):
+    """
+    Compute the one-sided pressure spectral density of every burst at once
+    using Welch's method: each burst in the (burst, sample) array pres is
+    split into 50% overlapping segments of nfft samples, which are linearly
+    detrended and Hann windowed before the FFT. By default nfft gives a
+    frequency resolution of DF. Short gaps where samples were dropped are
+    filled by fill_gaps; segments still containing NaNs are left out of the
+    average, and bursts with no complete segment get NaN spectra. Returns
+    frequency (excluding 0 Hz) and spectra shaped (burst, frequency).
+    """
+
+    pres = fill_gaps(np.atleast_2d(pres))
+    nsamples = pres.shape[-1]
+
+    if nfft is None:
+        nfft = int(round(fs / DF))
+    nfft = min(nfft, nsamples)
+    step = nfft // 2
+    nseg = (nsamples - nfft) // step + 1
+
+    # (burst, segment, nfft) view of the overlapping segments
+    idx = np.arange(nseg)[:, None] * step + np.arange(nfft)[None, :]
+    seg = pres[:, idx]
+
+    # linear detrend of every segment
+    x = np.arange(nfft) - (nfft - 1) / 2
+    seg = seg - seg.mean(axis=-1, keepdims=True)
+    slope = np.sum(seg * x, axis=-1, keepdims=True) / np.sum(x**2)
+    seg -= slope * x
+
+    window = np.hanning(nfft)
+    spec = np.abs(np.fft.rfft(seg * window, axis=-1))**2
+    complete = np.isfinite(spec[:, :, :1])
+    with np.errstate(invalid='ignore'):
+        spec = np.where(complete, spec, 0).sum(axis=1) / complete.sum(axis=1)
+
+    # scale to a one-sided density whose integral is the variance
+    spec *= 2 / (fs * np.sum(window**2))
+    if nfft % 2 == 0:
+        spec[:, -1] /= 2
+
+    return spectral_frequency(nsamples, fs, nfft), spec[:, 1:]
+
+
+def surface_spectra(pres, fs, height, nfft=None):
+    """
+    Surface elevation spectra (burst, frequency) from the burst pressure
+    data in pres, taking each burst's water depth as its mean pressure
+    (ignoring dropped samples) plus the sensor height. Works on any block
+    of bursts, so it can be mapped over chunks.
+    """
+
+    frequency, pspec = pressure_spectra(pres, fs, nfft)
+    with warnings.catch_warnings():
+        # bursts with no samples at all get NaN depth
+        warnings.simplefilter('ignore', RuntimeWarning)
+        depth = np.nanmean(pres, axis=-1) + height
+
+    return elevation_spectra(frequency, pspec, depth, height)
+
+
+def solve_dispersion(omega, depth):
+    """
+    Solve the linear dispersion relation omega^2 = g k tanh(k h) for the
+    wavenumber k, broadcasting omega against depth. Starts from the explicit
+    approximation of Guo (2002), which is within 1%, so a fixed number of
+    Newton steps reaches machine precision.
+    """
+
+    omega = np.asarray(omega, dtype=float)
+    depth = np.asarray(depth, dtype=float)
+
+    x = omega * np.sqrt(depth / G)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = x**2 * (1 - np.exp(-x**2.4908))**(-1 / 2.4908) / depth
+
+    for n in range(NEWTON_STEPS):
+        t = np.tanh(k * depth)
+        k = k - (G * k * t - omega**2) / (G * t + G * k * depth * (1 - t**2))
+
+    return k
+
+
+def wavenumber(frequency, depth):
+    """
+    Wavenumber for every combination of frequency (Hz) and depth (m),
+    shaped (depth, frequency). Depths are rounded to DEPTH_RESOLUTION and
+    the solutions are cached for each frequency grid, so only depths not
+    seen before with this grid are solved. NaN depths get NaN wavenumbers.
+    """
+
+    frequency = np.atleast_1d(np.asarray(frequency, dtype=float))
+    depth = np.atleast_1d(np.asarray(depth, dtype=float))
+
+    grid = _wavenumber_cache.setdefault(frequency.tobytes(), {})
+    if len(grid) > WAVENUMBER_CACHE_SIZE:
+        grid.clear()
+
+    k = np.full(depth.shape + frequency.shape, np.nan)
+    finite = np.isfinite(depth)
+    if not finite.any():
+        return k
+
+    depthbins, inverse = np.unique(np.round(depth[finite] / DEPTH_RESOLUTION).astype(np.int64),
+                                   return_inverse=True)
+    missing = np.array([d for d in depthbins if d not in grid], dtype=np.int64)
+    if len(missing):
+        grid.update(zip(missing, solve_dispersion(2 * np.pi * frequency[None, :],
+                                                  missing[:, None] * DEPTH_RESOLUTION)))
+
+    table = np.array([grid[d] for d in depthbins])
+    k[finite] = table[inverse.ravel()]
+
+    return k
+
+
+def pressure_response(frequency, depth, height):
+    """
+    Pressure response factor Kp = cosh(k z)/cosh(k h) for a sensor height
+    (m above bed) in water depth h, shaped (depth, frequency)
+    """
+
+    depth = np.asarray(depth, dtype=float)[:, None]
+    k = wavenumber(frequency, depth[:, 0])
+
+    return np.cosh(k * height) / np.cosh(k * depth)
+
+
+def elevation_spectra(frequency, pspec, depth, height):
+    """
+    Convert pressure spectra (burst, frequency) to surface elevation spectra
+    using the pressure response factor for each burst's depth. Bins where the
+    response factor is smaller than MINIMUM_KP are set to NaN.
+    """
+
+    kp = pressure_response(frequency, depth, height)
+
+    return np.where(kp >= MINIMUM_KP, pspec / kp**2, np.nan)
+
+
+def band_mask(frequency, fmin=None, fmax=None):
+    """Which frequencies are within [fmin, fmax] (Hz); either may be None"""
+
+    frequency = np.asarray(frequency, dtype=float)
+    inband = np.ones(frequency.shape, dtype=bool)
+    if fmin is not None:
+        inband &= frequency >= fmin
+    if fmax is not None:
+        inband &= frequency <= fmax
+
+    return inband
+
+
+def spectral_moments(frequency, spec, orders=(0, 1, 2), fmin=None, fmax=None):
+    """
+    Spectral moments m_n = sum(f^n S(f) df) of the spectra (burst,
+    frequency) for each n in orders, over the bins within [fmin, fmax] Hz.
+    NaN bins are excluded. All bursts are integrated at once as a single
+    matrix product. Returns an array shaped (burst, order).
+    """
+
+    frequency = np.asarray(frequency, dtype=float)
+    spec = np.atleast_2d(spec)
+
+    df = np.gradient(frequency) * band_mask(frequency, fmin, fmax)
+    weights = frequency[:, None]**np.asarray(orders)[None, :] * df[:, None]
+
+    return np.where(np.isfinite(spec), spec, 0).dot(weights)
+
+
+def bin_edges(frequency):
+    """
+    Edges of the frequency bins, halfway between frequencies, so the bin
+    widths are the np.gradient(frequency) spectral_moments integrates with
+    """
+
+    frequency = np.asarray(frequency, dtype=float)
+    mid = (frequency[1:] + frequency[:-1]) / 2
+
+    return np.concatenate(([2 * frequency[0] - mid[0]], mid, [2 * frequency[-1] - mid[-1]]))
+
+
+def regrid_spectra(frequency, spec, grid):
+    """
+    Rebin the spectra (burst, frequency) from frequency to the frequencies
+    in grid, all bursts at once, sharing the energy of each bin among the
+    grid bins it overlaps so m0 (and so wh) is unchanged. Grid bins outside
+    the original ones get NaN.
+    """
+
+    spec = np.atleast_2d(spec)
+    old = bin_edges(frequency)
+    new = bin_edges(grid)
+
+    # overlap (Hz) of each original bin with each grid bin
+    overlap = np.clip(np.minimum(old[1:, None], new[None, 1:]) -
+                      np.maximum(old[:-1, None], new[None, :-1]), 0, None)
+
+    valid = np.isfinite(spec)
+    out = np.where(valid, spec, 0).dot(overlap) / np.diff(new)
+    out[valid.dot(overlap) == 0] = np.nan
+
+    return out
+
+
+def band_statistics(frequency, spec, fmin=None, fmax=None):
+    """
+    Compute the spectral moments m0, m1 and m2, significant wave height
+    (wh), peak period (wp_peak) and mean periods m0/m1 (wp_mean) and
+    sqrt(m0/m2) (wp_zero) from the elevation spectra (burst, frequency),
+    using only the bins within [fmin, fmax] Hz. NaN bins are excluded;
+    bursts with no valid bins in the band get NaN. Returns a dict of
+    (burst,) arrays.
+    """
+
+    frequency = np.asarray(frequency, dtype=float)
+    spec = np.atleast_2d(spec)
+
+    inband = band_mask(frequency, fmin, fmax)
+    valid = np.isfinite(spec) & inband
+    s = np.where(valid, spec, 0)
+
+    m0, m1, m2 = spectral_moments(frequency, s, (0, 1, 2)).T
+
+    empty = ~np.any(valid, axis=-1) | (m0 <= 0)
+    m0 = np.where(empty, np.nan, m0)
+
+    # a peak in the 0 Hz bin or outside the band has no period
+    peak = np.argmax(s, axis=-1)
+    ok = (~empty & (frequency[peak] > 0) &
+          np.take_along_axis(valid, peak[..., None], axis=-1)[..., 0])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wp_peak = np.where(ok, 1 / frequency[peak], np.nan)
+
+        return {'m0': m0, 'm1': m1, 'm2': m2,
+                'wh': 4 * np.sqrt(m0),
+                'wp_peak': wp_peak,
+                'wp_mean': m0 / m1,
+                'wp_zero': np.sqrt(m0 / m2)}
+
+
+def wave_statistics(frequency, spec):
+    """
+    Compute significant wave height, peak period and mean period (m0/m1)
+    from the elevation spectra (burst, frequency). NaN bins are excluded;
+    bursts with no valid bins get NaN.
+    """
+
+    stats = band_statistics(frequency, spec)
+
+    return stats['wh'], stats['wp_peak'], stats['wp_mean']
@@ -0,0 +1,17 @@
+from setuptools import setup
+
+# aqdlib (https://github.com/dnowacki-usgs/aqdlib) is also needed by
+# rskcdf2nc to clip data not already clipped when read from the RSK file
+
+setup(name='rsklib',
+      description='Process RBR d|wave data in Python',
+      url='https://github.com/dnowacki-usgs/rsklib',
+      packages=['rsklib'],
+      install_requires=['numpy', 'pandas', 'xarray', 'netCDF4', 'pyyaml'],
+      entry_points={'console_scripts': ['rskrsk2cdf=rsklib.rskrsk2cdf:main',
+                                        'rskcdf2nc=rsklib.rskcdf2nc:main',
+                                        'rsknc2diwasp=rsklib.rsknc2diwasp:main',
+                                        'rskpipeline=rsklib.rskpipeline:main',
+                                        'rskbatch=rsklib.rskbatch:main',
+                                        'rskwatch=rsklib.rskwatch:main',
+                                        'rskbench=rsklib.rskbench:main']})
@@ -0,0 +1,11 @@
+from __future__ import division, print_function
+
+from rsklib import rskbench
+
+
+def test_imports_are_light():
+    # each import runs in a fresh interpreter, so this takes a few seconds
+    imports, problems = rskbench.measure_imports()
+
+    assert set(imports) == set(['rsklib'] + ['rsklib.' + m for m in rskbench.ENTRY_POINTS])
+    assert not problems, '; '.join(problems)
@@ -0,0 +1,97 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4
+from rsklib import ncio
+
+
+def make_bursts(times, samples=4):
+    return xr.Dataset({'P_1': (('time', 'sample'), np.random.RandomState(0).rand(len(times), samples))},
+                      coords={'time': pd.DatetimeIndex(times)})
+
+
+def write(ds, filename):
+    ds, encoding = ncio.netcdf_encoding(ds)
+    ds.to_netcdf(filename, unlimited_dims=['time'], encoding=encoding)
+
+
+def test_append_netcdf_long_record(tmp_path):
+    filename = str(tmp_path / 'x-raw.cdf')
+    # a year of hourly bursts, then bursts only 4 minutes apart
+    times = pd.date_range('2017-01-01', periods=24 * 366, freq='h')
+    write(make_bursts(times), filename)
+
+    new = times[-1] + pd.to_timedelta([4, 8], unit='min')
+    ncio.append_netcdf(filename, make_bursts(new))
+
+    with netCDF4.Dataset(filename) as nc:
+        assert len(nc.dimensions['time']) == len(times) + 2
+
+    got = xr.open_dataset(filename)['time'].values
+    np.testing.assert_array_equal(got[-3:], np.concatenate((times[-1:], new)).astype('datetime64[ns]'))
+
+
+def test_append_netcdf_reread_burst(tmp_path):
+    filename = str(tmp_path / 'x-raw.cdf')
+    times = pd.date_range('2017-01-01', periods=10, freq='h')
+    write(make_bursts(times[:5]), filename)
+
+    # the last burst is read again, with the rest of the record
+    ds = make_bursts(times[4:])
+    ncio.append_netcdf(filename, ds)
+
+    got = xr.open_dataset(filename)
+    np.testing.assert_array_equal(got['time'].values, times.values)
+    np.testing.assert_allclose(got['P_1'].values[4:], ds['P_1'].values)
+
+
+def test_netcdf_encoding_profiles(tmp_path):
+    ds = make_bursts(pd.date_range('2017-01-01', periods=6, freq='h'), samples=32)
+    ds['P_1'] = 10 + ds['P_1']
+    ds['P_1'][2, 5] = np.nan
+    ds['P_1'].attrs['units'] = 'dbar'
+
+    for profile, dtype, atol in [('none', 'float64', 0), ('zlib', 'float64', 0),
+                                 ('float32', 'float32', 1e-6),
+                                 ('int16', 'int16', ncio.INT16_RESOLUTION / 2)]:
+        filename = str(tmp_path / (profile + '.nc'))
+        encoded, encoding = ncio.netcdf_encoding(ds, profile)
+        encoded.to_netcdf(filename, unlimited_dims=['time'], encoding=encoding)
+
+        with netCDF4.Dataset(filename) as nc:
+            assert nc.variables['P_1'].dtype == np.dtype(dtype)
+            assert nc.variables['time'].units.startswith('milliseconds since')
+
+        got = xr.open_dataset(filename)
+        np.testing.assert_allclose(got['P_1'].values, ds['P_1'].values, rtol=0, atol=atol + 1e-12)
+        np.testing.assert_array_equal(got['time'].values, ds['time'].values)
+
+
+def test_append_netcdf_int16(tmp_path):
+    filename = str(tmp_path / 'x-raw.cdf')
+    times = pd.date_range('2017-01-01', periods=6, freq='h')
+    ds = make_bursts(times)
+    ds, encoding = ncio.netcdf_encoding(ds, 'int16')
+    ds.to_netcdf(filename, unlimited_dims=['time'], encoding=encoding)
+
+    # appended bursts are packed with the scale and offset already in the file
+    new = make_bursts(times[-1] + pd.to_timedelta([1, 2], unit='h'))
+    ncio.append_netcdf(filename, new)
+
+    got = xr.open_dataset(filename)
+    np.testing.assert_allclose(got['P_1'].values[-2:], new['P_1'].values,
+                               rtol=0, atol=ncio.INT16_RESOLUTION / 2 + 1e-12)
+
+
+def test_write_zarr_round_trip(tmp_path):
+    ds = make_bursts(pd.date_range('2017-01-01', periods=5, freq='h'), samples=8)
+    filename = str(tmp_path / 'x-raw.cdf')
+
+    for zarr in ['dir', 'zip']:
+        ncio.write_zarr(ds, filename, encoding='float32', zarr=zarr)
+
+        got = ncio.open_store(filename, zarr).load()
+        np.testing.assert_array_equal(got['time'].values, ds['time'].values)
+        np.testing.assert_allclose(got['P_1'].values, ds['P_1'].values, rtol=1e-7)
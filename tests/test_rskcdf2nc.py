@@ -0,0 +1,91 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+from rsklib import rskcdf2nc, rskrsk2cdf
+from test_rskrsk2cdf import make_gappy_rsk
+
+
+def test_datetime_to_epic():
+    times = np.array(['1970-01-01T00:00:00', '2017-07-14T02:40:00.0005',
+                      '1969-12-31T23:59:59.999', '2000-01-01T12:00:00'], dtype='datetime64[ns]')
+
+    epic_time, epic_time2 = rskcdf2nc.datetime_to_epic(times)
+
+    np.testing.assert_array_equal(epic_time, [2440588, 2457949, 2440587, 2451545])
+    np.testing.assert_array_equal(epic_time2, [0, 9600001, 86399999, 43200000])
+    assert epic_time.dtype == np.int32 and epic_time2.dtype == np.int32
+
+
+def test_datetime_to_epic_shape():
+    times = np.datetime64('2017-07-14T02:40') + np.arange(6).reshape((2, 3)) * np.timedelta64(250, 'ms')
+
+    epic_time, epic_time2 = rskcdf2nc.datetime_to_epic(times)
+
+    assert epic_time.shape == (2, 3)
+    np.testing.assert_array_equal(epic_time2.ravel(), 9600000 + 250 * np.arange(6))
+
+
+def test_xr_to_nc_clip_settings(tmp_path):
+    metadata, starts = make_gappy_rsk(tmp_path, 10, [3])
+    metadata['good_ens'] = [2, 8]
+    ds, metadata = rskrsk2cdf.rsk_to_xr(metadata)
+
+    # clipped with the same good_ens, so not clipped again
+    nc = rskcdf2nc.xr_to_nc(ds.copy(), dict(metadata))
+    assert len(nc['time']) == 6
+
+    # the indices of a different good_ens refer to the unclipped record
+    metadata['good_ens'] = [3, 8]
+    with pytest.raises(ValueError):
+        rskcdf2nc.xr_to_nc(ds.copy(), metadata)
+
+
+def test_xr_to_nc_drops_diagnostics(tmp_path):
+    metadata, starts = make_gappy_rsk(tmp_path, 4, [])
+    metadata['good_ens'] = [0, None]
+    ds, metadata = rskrsk2cdf.rsk_to_xr(metadata)
+    assert 'P_1_spikes' in ds and 'burst_completeness' in ds
+
+    nc = rskcdf2nc.xr_to_nc(ds, metadata)
+
+    assert not [k for k in nc.variables if k.startswith('P_1_') or k == 'burst_completeness']
+    assert 'P_1' in nc
+
+
+def test_atmospheric_correction_interpolates(tmp_path):
+    times = pd.date_range('2018-01-01 00:30', periods=6, freq='h')
+    ds = xr.Dataset({'P_1': xr.DataArray(np.full((6, 4), 20.), dims=('time', 'sample'),
+                                         attrs={'units': 'dbar'})},
+                    coords={'time': times})
+
+    # hourly met record, out of order, with 00:00-01:00 and a 3 hour gap
+    # from 02:00, ending before the last burst
+    metimes = pd.to_datetime(['2018-01-01 02:00', '2018-01-01 00:00', '2018-01-01 01:00',
+                              '2018-01-01 05:00'])
+    met = xr.Dataset({'atmpres': xr.DataArray([10.2, 10., 10.1, 10.5], dims='time',
+                                              attrs={'offset': 0.1})},
+                     coords={'time': metimes})
+    met.to_netcdf(str(tmp_path / 'met.nc'))
+
+    ds = rskcdf2nc.atmospheric_correction(ds, str(tmp_path / 'met.nc'), max_gap=7200)
+
+    expected = 20 - 0.1 - np.array([10.05, 10.15, np.nan, np.nan, np.nan, np.nan])
+    np.testing.assert_allclose(ds['P_1ac'].values[:, 0], expected)
+    assert ds['P_1ac'].attrs['units'] == 'dbar'
+
+    # without max_gap the gap is interpolated across
+    ds = rskcdf2nc.atmospheric_correction(ds, met)
+    np.testing.assert_allclose(ds['P_1ac'].values[2:5, 0], 20 - 0.1 - (10.2 + np.array([1, 3, 5]) * 0.05))
+    assert np.isnan(ds['P_1ac'].values[5]).all()
+
+
+def test_create_epic_time_jd():
+    times = np.datetime64('2017-07-14T18:00') + np.arange(3) * np.timedelta64(1, 'h')
+    ds = rskcdf2nc.create_epic_time(xr.Dataset(coords={'time': times}))
+
+    np.testing.assert_array_equal(ds['epic_time'].values, 2457949)
+    np.testing.assert_array_equal(ds['epic_time2'].values, [64800000, 68400000, 72000000])
+    np.testing.assert_allclose(ds['jd'].values, 2457949 + np.array([18, 19, 20]) / 24)
@@ -0,0 +1,36 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+import xarray as xr
+from rsklib import rsknc2diwasp
+
+
+def make_waves():
+    """Wave statistics for five bursts, each failing a different rule"""
+
+    return xr.Dataset({'wh_4061': ('time', [1., 0.01, 1., 1., 6.]),
+                       'wp_peak': ('time', [8., 8., 25., 20., 8.]),
+                       'wp_4060': ('time', [6., 6., 6., 4., 6.]),
+                       'pspec': (('time', 'frequency'), np.ones((5, 3)))})
+
+
+def test_apply_qc_flags():
+    metadata = {'maximum_wp': 21, 'minimum_wh': 0.05, 'wp_ratio': 4,
+                'qc_rules': [{'name': 'maximum_wh', 'variables': ['wh_4061'], 'max': 5,
+                              'targets': ['wh_4061', 'pspec']}]}
+
+    ds = rsknc2diwasp.apply_qc(make_waves(), metadata)
+
+    np.testing.assert_array_equal(ds['qc_flag'].values, [0, 2, 1 | 4, 4, 8])
+    assert ds['qc_flag'].attrs['flag_meanings'] == 'maximum_wp minimum_wh wp_ratio maximum_wh'
+    np.testing.assert_array_equal(np.isnan(ds['wh_4061'].values), [False, True, False, False, True])
+    np.testing.assert_array_equal(np.isnan(ds['wp_peak'].values), [False, True, True, True, False])
+    np.testing.assert_array_equal(np.isnan(ds['pspec'].values[:, 0]), [False, False, False, False, True])
+    # the latest rule's note comes first
+    assert ds['wh_4061'].attrs['note'].startswith('Values filled where wh_4061 >= 5')
+
+
+def test_read_qc_rules_needs_limit():
+    with pytest.raises(ValueError):
+        rsknc2diwasp.read_qc_rules({'qc_rules': [{'name': 'bad', 'variables': ['wh_4061']}]})
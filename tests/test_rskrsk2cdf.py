@@ -0,0 +1,288 @@
+from __future__ import division, print_function
+
+import warnings
+import sqlite3
+import numpy as np
+from rsklib import rskrsk2cdf, rskbench
+
+T0 = 1500000000000  # ms
+
+
+def make_record(nbursts, samplingcount, samplingperiod, idle, drift=0.):
+    """
+    Return burstdata arrays for a schedule with idle sampling periods
+    between bursts, each burst starting drift ms later than the schedule
+    says, and the burst start times
+    """
+
+    repetitionperiod = (samplingcount + idle) * samplingperiod
+    starts = T0 + np.arange(nbursts) * (repetitionperiod + drift)
+    t = np.round(starts[:, None] + np.arange(samplingcount) * samplingperiod).astype(np.int64)
+    pres = np.arange(t.size, dtype=float).reshape(t.shape)
+
+    return {'unixtime': t.ravel(), 'channel01': pres.ravel()}, repetitionperiod, starts
+
+
+def check_bursts(b, a, keep, samplingcount, starts):
+    """Check each kept sample of a ended up in its own burst and sample"""
+
+    pres = np.full(len(a['unixtime']), np.nan)
+    pres[keep] = a['channel01'][keep]
+    pres = pres.reshape((-1, samplingcount))
+
+    np.testing.assert_array_equal(b['channel01'], pres)
+    np.testing.assert_array_equal(b['unixtime'], np.round(starts))
+    np.testing.assert_allclose(b['completeness'], np.isfinite(pres).mean(axis=1))
+
+
+def drop(a, keep):
+    return dict((k, a[k][keep]) for k in a)
+
+
+def make_gappy_rsk(directory, nbursts, missing, samples=16, samplingperiod=500,
+                   repetitionperiod=60000):
+    """
+    Write a synthetic .rsk file in directory with the bursts numbered in
+    missing left out, and return metadata for reading it and the burst
+    start times of the full schedule
+    """
+
+    basefile = str(directory / 'gappy')
+    t0 = rskbench.make_rsk(basefile + '.rsk', nbursts, samples, samplingperiod, repetitionperiod)
+    starts = t0 + np.arange(nbursts) * repetitionperiod
+
+    conn = sqlite3.connect(basefile + '.rsk')
+    for n in missing:
+        conn.execute('DELETE FROM burstdata WHERE tstamp >= ? AND tstamp < ?',
+                     (int(starts[n]), int(starts[n] + repetitionperiod)))
+    conn.commit()
+    conn.close()
+
+    metadata = {'basefile': basefile,
+                'filename': basefile,
+                'initial_instrument_height': 0.5,
+                'latitude': 40.,
+                'longitude': -70.,
+                'WATER_DEPTH': 10.}
+
+    return metadata, np.delete(starts, missing)
+
+
+def test_segment_bursts_complete():
+    a, rep, starts = make_record(4, 1024, 250, 40)
+    b = rskrsk2cdf.segment_bursts(a, 1024, 250, rep)
+
+    check_bursts(b, a, np.ones(4 * 1024, dtype=bool), 1024, starts)
+
+
+def test_segment_bursts_dropouts():
+    a, rep, starts = make_record(6, 1024, 250, 40)
+    keep = np.ones(6 * 1024, dtype=bool)
+    # a dropout shorter than the idle time, one at the start of a burst and
+    # one across the end of a burst and the start of the next
+    keep[2 * 1024 + 500:2 * 1024 + 530] = False
+    keep[3 * 1024:3 * 1024 + 30] = False
+    keep[5 * 1024 - 10:5 * 1024 + 20] = False
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        b = rskrsk2cdf.segment_bursts(drop(a, keep), 1024, 250, rep)
+
+    check_bursts(b, a, keep, 1024, starts)
+
+
+def test_segment_bursts_leading_dropout():
+    a, rep, starts = make_record(5, 1024, 250, 40)
+    keep = np.ones(5 * 1024, dtype=bool)
+    keep[:30] = False
+
+    b = rskrsk2cdf.segment_bursts(drop(a, keep), 1024, 250, rep)
+
+    check_bursts(b, a, keep, 1024, starts)
+
+
+def test_segment_bursts_short_idle():
+    a, rep, starts = make_record(20, 1024, 250, 2)
+    keep = np.random.RandomState(0).rand(20 * 1024) > 0.01
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        b = rskrsk2cdf.segment_bursts(drop(a, keep), 1024, 250, rep)
+
+    check_bursts(b, a, keep, 1024, starts)
+
+
+def test_segment_bursts_drift():
+    # the bursts drift a whole sampling period over the record
+    a, rep, starts = make_record(20, 1024, 250, 2, drift=250 / 19)
+    keep = np.random.RandomState(1).rand(20 * 1024) > 0.01
+
+    b = rskrsk2cdf.segment_bursts(drop(a, keep), 1024, 250, rep)
+
+    np.testing.assert_array_equal(b['channel01'][np.isfinite(b['channel01'])],
+                                  a['channel01'][keep])
+    np.testing.assert_array_equal(np.isfinite(b['channel01']).ravel(), keep)
+    assert np.all(np.abs(b['unixtime'] - starts) <= 1)
+
+
+def test_segment_bursts_continuous():
+    a, rep, starts = make_record(3, 512, 125, 0)
+    keep = np.ones(3 * 512, dtype=bool)
+    keep[700:710] = False
+
+    b = rskrsk2cdf.segment_bursts(drop(a, keep), 512, 125, rep)
+
+    check_bursts(b, a, keep, 512, starts)
+
+
+def test_segment_bursts_single_burst():
+    # a burst that lost its first samples, read on its own as when appending
+    a, rep, starts = make_record(3, 512, 250, 64)
+    keep = np.arange(3 * 512) >= 2 * 512 + 30
+    expected = np.full(512, np.nan)
+    expected[30:] = a['channel01'][2 * 512 + 30:]
+
+    b = rskrsk2cdf.segment_bursts(drop(a, keep), 512, 250, rep, origin=int(starts[1]))
+
+    np.testing.assert_array_equal(b['unixtime'], starts[2:])
+    np.testing.assert_array_equal(b['channel01'], expected[None, :])
+
+
+def test_segment_bursts_empty():
+    a = {'unixtime': np.empty(0, dtype=np.int64), 'channel01': np.empty(0)}
+    b = rskrsk2cdf.segment_bursts(a, 1024, 250, 266500)
+
+    assert b['channel01'].shape == (0, 1024)
+    assert len(b['unixtime']) == 0
+
+
+def test_sort_burstdata_sorted():
+    a, rep, starts = make_record(2, 16, 250, 4)
+    t = a['unixtime'].copy()
+
+    assert rskrsk2cdf.sort_burstdata(a) == 'already sorted'
+    np.testing.assert_array_equal(a['unixtime'], t)
+
+
+def test_sort_burstdata_runs():
+    a, rep, starts = make_record(4, 16, 250, 4)
+    expected = dict((k, a[k].copy()) for k in a)
+    # swap two bursts and move one sample, leaving the ends in place
+    order = np.concatenate((np.arange(16), np.arange(32, 48), np.arange(16, 32),
+                            np.arange(48, 60), [62, 60, 61, 63]))
+    a = drop(a, order)
+
+    assert rskrsk2cdf.sort_burstdata(a).startswith('sorted')
+    for k in a:
+        np.testing.assert_array_equal(a[k], expected[k])
+
+
+def test_read_rsk_good_ens_gap(tmp_path):
+    # good_ens counts the bursts present, as clip_ds does, not schedule slots
+    for good_ens, expected in [([2, 8], slice(2, 8)), ([5, None], slice(5, None)),
+                               ([1, -2], slice(1, -2))]:
+        metadata, starts = make_gappy_rsk(tmp_path, 10, [3])
+        metadata['good_ens'] = good_ens
+
+        b, channels = rskrsk2cdf.read_rsk(metadata)
+
+        np.testing.assert_array_equal(b['unixtime'], starts[expected])
+        assert metadata['rsk_clipped'] == 'good_ens'
+        assert metadata['rsk_clip_settings'] == rskrsk2cdf.clip_settings(metadata)
+
+
+
+def test_cached_read_rsk_metadata(tmp_path):
+    metadata, starts = make_gappy_rsk(tmp_path, 4, [2])
+    cachedir = str(tmp_path / 'cache')
+
+    # metadata already holding what read_rsk derives, as when it is reused
+    reread = dict(metadata)
+    rskrsk2cdf.read_rsk(reread)
+    a, channels = rskrsk2cdf.cached_read_rsk(reread, cachedir)
+
+    cached = dict(metadata)
+    ds, cached = rskrsk2cdf.rsk_to_xr(cached, cache=cachedir)
+
+    for k in rskrsk2cdf.CACHE_METADATA:
+        assert cached.get(k) == reread.get(k)
+    np.testing.assert_array_equal(ds['P_1'].values, a['channel01'])
+
+
+def make_channels_db():
+    """
+    A cursor, as init_connection returns, on an in-memory burstdata table with
+    two pressure channels, a temperature channel and a derived channel that
+    is not stored
+    """
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE burstdata (tstamp BIGINT, channel01 DOUBLE, channel02 DOUBLE, '
+                 'channel04 DOUBLE)')
+    conn.execute('CREATE TABLE channels (channelID INTEGER PRIMARY KEY, shortName TEXT, '
+                 'longName TEXT, units TEXT)')
+    conn.executemany('INSERT INTO channels VALUES (?, ?, ?, ?)',
+                     [(1, 'pres08', 'Pressure', 'dbar'), (2, 'temp14', 'Temperature', 'degC'),
+                      (3, 'dpth01', 'Depth', 'm'), (4, 'pres09', 'Pressure', 'dbar')])
+    conn.executemany('INSERT INTO burstdata VALUES (?, ?, ?, ?)',
+                     [(T0 + 250 * n, 10. + n, 20. + n, 30. + n) for n in range(5)])
+
+    return conn.cursor()
+
+
+def test_read_channels_repeated():
+    conn = make_channels_db()
+
+    channels = rskrsk2cdf.read_channels(conn, {})
+    assert [c[:2] for c in channels] == [('channel01', 'P_1'), ('channel02', 'T_28'),
+                                         ('channel04', 'P_1_2')]
+
+    # names do not depend on which channels are selected
+    channels = rskrsk2cdf.read_channels(conn, {'channels': ['P_1_2']})
+    assert [c[:2] for c in channels] == [('channel04', 'P_1_2')]
+
+
+def test_read_burstdata_columns():
+    conn = make_channels_db()
+
+    a = rskrsk2cdf.read_burstdata(conn, ['channel01', 'channel04'], chunksize=2, order=True)
+
+    np.testing.assert_array_equal(a['unixtime'], T0 + 250 * np.arange(5))
+    np.testing.assert_array_equal(a['channel01'], 10. + np.arange(5))
+    np.testing.assert_array_equal(a['channel04'], 30. + np.arange(5))
+    assert 'channel02' not in a
+
+
+def test_read_burstdata_parallel(tmp_path, monkeypatch):
+    monkeypatch.setattr(rskrsk2cdf, 'PARTITION_ROWS', 100)
+    schedule = (64, 250, 60000)
+
+    for index, processes in [(False, False), (True, False), (True, True)]:
+        rskfile = str(tmp_path / ('parallel%d%d.rsk' % (index, processes)))
+        t0 = rskbench.make_rsk(rskfile, 20, 64, 250, 60000, shuffle=True, drop=0.05, index=index)
+        tstamps = (t0 + 3 * 60000 - 1000, t0 + 15 * 60000 - 1000)
+
+        conn = rskrsk2cdf.init_connection(rskfile)
+        expected = rskrsk2cdf.read_burstdata(conn, ['channel01'], tstamps=tstamps, order=True)
+        conn.connection.close()
+
+        a = rskrsk2cdf.read_burstdata_parallel(rskfile, ['channel01'], 4, chunksize=50,
+                                               tstamps=tstamps, order=index, schedule=schedule,
+                                               processes=processes, immutable=True)
+        if not index:
+            rskrsk2cdf.sort_burstdata(a)
+
+        for k in expected:
+            np.testing.assert_array_equal(a[k], expected[k])
+
+
+def test_read_rsk_unindexed_shuffled(tmp_path):
+    basefile = str(tmp_path / 'shuffled')
+    t0 = rskbench.make_rsk(basefile + '.rsk', 40, 16, 500, 60000, shuffle=True)
+
+    metadata = {'basefile': basefile}
+    b, channels = rskrsk2cdf.read_rsk(metadata, clip=False)
+
+    assert metadata['rsk_sort'].startswith('sorted')
+    np.testing.assert_array_equal(b['unixtime'], t0 + 60000 * np.arange(40))
+    assert np.all(b['completeness'] == 1)
@@ -0,0 +1,94 @@
+from __future__ import division, print_function
+
+import numpy as np
+from rsklib import waves
+
+
+def make_spectra(frequency, nbursts=4, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.gamma(2, size=(nbursts, len(frequency))) * np.exp(-((frequency - 0.3) / 0.04)**2)
+
+
+def test_regrid_spectra_conserves_m0():
+    frequency = np.linspace(0, 2, 257)
+    spec = make_spectra(frequency)
+    m0 = waves.spectral_moments(frequency, spec, (0,))
+
+    for grid in [np.arange(0, 2.001, 0.01), np.arange(0.02, 1, 0.05), np.linspace(0, 2, 1025)]:
+        regridded = waves.regrid_spectra(frequency, spec, grid)
+        np.testing.assert_allclose(waves.spectral_moments(grid, regridded, (0,)), m0, rtol=1e-10)
+
+
+def test_regrid_spectra_outside():
+    frequency = np.linspace(0.1, 0.5, 41)
+    spec = make_spectra(frequency)
+
+    regridded = waves.regrid_spectra(frequency, spec, np.array([0.01, 0.02, 0.3, 0.8, 0.9]))
+
+    assert np.all(np.isnan(regridded[:, [0, 3, 4]]))
+    assert np.all(np.isfinite(regridded[:, 1:3]))
+
+
+def test_wavenumber_nan_depth():
+    frequency = np.array([0.05, 0.1, 0.2])
+
+    k = waves.wavenumber(frequency, [np.nan, 10., np.inf])
+
+    assert np.all(np.isnan(k[[0, 2]]))
+    np.testing.assert_allclose(k[1], waves.solve_dispersion(2 * np.pi * frequency, 10.), rtol=1e-3)
+
+
+def test_surface_spectra_dropped_samples():
+    fs = 4
+    rng = np.random.RandomState(0)
+    pres = 10 + 0.5 * np.sin(2 * np.pi * 0.1 * np.arange(2048) / fs) + 0.01 * rng.randn(3, 2048)
+    pres[1, 700] = np.nan
+    pres[2, :] = np.nan
+
+    frequency = waves.spectral_frequency(2048, fs)
+    wh, wp_peak, wp_mean = waves.wave_statistics(frequency, waves.surface_spectra(pres, fs, 0.5))
+
+    np.testing.assert_allclose(wh[1], wh[0], rtol=0.01)
+    assert np.isnan(wh[2])
+
+
+def test_band_statistics_peak_period():
+    frequency = np.linspace(0, 0.5, 6)
+    spec = np.array([[5., 1., 2., 0., 0., 0.],
+                     [0., 1., 2., 0., 0., 0.],
+                     [0., 0., 0., 0., 0., 0.]])
+
+    with np.errstate(all='raise'):
+        stats = waves.band_statistics(frequency, spec)
+        inband = waves.band_statistics(frequency, spec, fmin=0.1)
+
+    # the peak in the 0 Hz bin has no period, and the peak outside the band
+    # is not used
+    np.testing.assert_allclose(stats['wp_peak'], [np.nan, 5, np.nan])
+    np.testing.assert_allclose(inband['wp_peak'], [5, 5, np.nan])
+
+
+def test_fill_gaps():
+    pres = np.arange(24, dtype=float).reshape((2, 12))
+    pres[0, [0, 3, 4, 5]] = np.nan
+    pres[1, 2:8] = np.nan
+
+    filled = waves.fill_gaps(pres, maxgap=4)
+
+    # a gap at the start of a burst, or longer than maxgap, is left
+    np.testing.assert_array_equal(filled[0, 1:], np.arange(1, 12))
+    assert np.isnan(filled[0, 0])
+    np.testing.assert_array_equal(np.isnan(filled[1]), np.isnan(pres[1]))
+
+
+def test_pressure_spectra_short_gap():
+    fs = 4
+    rng = np.random.RandomState(1)
+    pres = 10 + 0.5 * np.sin(2 * np.pi * 0.1 * np.arange(2048) / fs) + 0.01 * rng.randn(2, 2048)
+    # one dropped sample in every segment
+    pres[1, 100::256] = np.nan
+
+    frequency, spec = waves.pressure_spectra(pres, fs)
+
+    assert np.all(np.isfinite(spec))
+    np.testing.assert_allclose(spec[1].sum(), spec[0].sum(), rtol=0.01)